@@ -0,0 +1,132 @@
+"""
+Local stand-in for the Discord REST API and the gateway payloads the replay needs, nothing goes over the network
+"""
+import collections
+import datetime
+import itertools
+import time
+
+import discord
+
+BOT_USER_ID = 1
+
+
+def user_payload(user_id: int, bot: bool = False):
+    return {'id': str(user_id), 'username': f'user{user_id}', 'discriminator': '0', 'global_name': None,
+            'avatar': None, 'bot': bot}
+
+
+def member_payload(user_id: int, role_ids):
+    return {'user': user_payload(user_id), 'roles': [str(i) for i in role_ids], 'flags': 0, 'deaf': False,
+            'mute': False, 'joined_at': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+
+
+def role_payload(role_id: int):
+    return {'id': str(role_id), 'name': f'role{role_id}', 'position': 0, 'permissions': '0', 'color': 0,
+            'hoist': False, 'managed': False, 'mentionable': False, 'flags': 0}
+
+
+def channel_payload(guild_id: int, channel_id: int):
+    return {'id': str(channel_id), 'guild_id': str(guild_id), 'type': 0, 'name': f'channel{channel_id}',
+            'position': 0, 'permission_overwrites': [], 'nsfw': False, 'parent_id': None, 'topic': None,
+            'rate_limit_per_user': 0}
+
+
+def guild_payload(guild_id: int, role_ids, channel_ids, members: dict):
+    """
+    :param guild_id: The guild ID, also the ID of its @everyone role
+    :param role_ids: The IDs of the roles of the guild
+    :param channel_ids: The IDs of the text channels of the guild
+    :param members: A dict of user ID to their role IDs, the bot itself is always added
+    :return: A GUILD_CREATE like payload
+    """
+    members = dict(members)
+    members.setdefault(BOT_USER_ID, [])
+    return {'id': str(guild_id), 'name': 'replay', 'owner_id': str(BOT_USER_ID), 'member_count': len(members),
+            'roles': [role_payload(i) for i in {guild_id, *role_ids}],
+            'channels': [channel_payload(guild_id, i) for i in channel_ids],
+            'members': [member_payload(user_id, roles) for user_id, roles in members.items()],
+            'features': [], 'emojis': [], 'stickers': []}
+
+
+def message_payload(channel_id: int, message_id: int, content: str = ''):
+    return {'id': str(message_id), 'channel_id': str(channel_id), 'type': 0, 'content': content or '',
+            'author': user_payload(BOT_USER_ID, bot=True), 'embeds': [], 'attachments': [], 'mentions': [],
+            'mention_roles': [], 'mention_everyone': False, 'tts': False, 'pinned': False, 'flags': 0,
+            'reactions': [], 'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'edited_timestamp': None}
+
+
+class FakeREST:
+    """
+    Replaces `HTTPClient.request`, answering every call locally, counting them per route and logging them
+    """
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.log = []
+        self._ids = itertools.count(int(time.time() * 1000) << 22)
+
+    @property
+    def total(self):
+        return sum(self.calls.values())
+
+    async def request(self, route, *, files=None, form=None, **kwargs):
+        self.calls[route.key] += 1
+        # eg. ('DELETE', '.../channels/1/messages/2/reactions/%F0%9F%8E%89/3') for a reaction removal
+        self.log.append((route.method, route.url))
+        if route.method == 'POST' and route.path == '/users/@me/channels':
+            return {'id': str(next(self._ids)), 'type': 1, 'last_message_id': None,
+                    'recipients': [user_payload(int(kwargs['json']['recipient_id']))]}
+        if route.path.endswith('/messages') and route.method == 'POST':
+            payload = kwargs.get('json') or {}
+            return message_payload(int(route.channel_id), next(self._ids), payload.get('content'))
+        if route.path == '/channels/{channel_id}/messages/{message_id}' and route.method in ('GET', 'PATCH'):
+            message_id = int(route.url.split('/messages/')[1].split('/')[0])
+            return message_payload(int(route.channel_id), message_id)
+        if '/reactions/' in route.path and route.method == 'GET':
+            return []
+        return None
+
+
+class FakeResponse:
+    def __init__(self, status: int, reason: str, headers: dict):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+
+class RateLimitedREST(FakeREST):
+    """
+    A :class:`FakeREST` rate limiting every channel to `limit` requests per `per` seconds, like Discord limits the
+    reaction routes, answering over the limit with 429s
+    Requests sent to a channel before the time its last 429 asked to wait for are counted as violations
+    """
+
+    def __init__(self, limit: int = 1, per: float = 0.25):
+        super().__init__()
+        self.limit = limit
+        self.per = per
+        self.rate_limited = 0
+        self.violations = 0
+        # channel ID -> (window start, requests in the window, retry not before)
+        self._buckets = {}
+
+    async def request(self, route, *, files=None, form=None, **kwargs):
+        now = time.monotonic()
+        channel_id = route.channel_id
+        start, count, retry_at = self._buckets.get(channel_id, (now, 0, 0))
+        if now < retry_at:
+            self.violations += 1
+        if now - start >= self.per:
+            start, count = now, 0
+        if count >= self.limit:
+            retry_after = self.per - (now - start)
+            self.rate_limited += 1
+            self._buckets[channel_id] = (start, count, now + retry_after)
+            headers = {'Retry-After': f'{retry_after:.3f}', 'X-RateLimit-Scope': 'user'}
+            raise discord.HTTPException(FakeResponse(429, 'Too Many Requests', headers),
+                                        {'message': 'You are being rate limited.', 'retry_after': retry_after,
+                                         'global': False})
+        self._buckets[channel_id] = (start, count + 1, retry_at)
+        return await super().request(route, files=files, form=form, **kwargs)
@@ -0,0 +1,256 @@
+"""
+Benchmarks of the reaction and roll hot paths
+
+Run it from the repository root against a scratch database, as it creates and deletes giveaways and templates,
+bot.py is imported and reads token.json like the bot does:
+    python -m benchmarks.hot_paths --dsn postgresql://localhost/sbz_bench --output results.json
+
+Pass a previous output as --baseline to fail (exit code 1) when a metric regresses past --threshold
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+
+import asyncpg
+import discord
+
+import bot as sbz
+import db
+from benchmarks.fake_rest import FakeREST
+from benchmarks.replay import Replay
+
+GUILD_ID = 1000
+CHANNEL_ID = 1001
+REQUIRED_ROLES = [10, 11]
+WEIGHTS = {11: 3}
+TEMPLATE_PREFIX = 'bench_'
+
+# query -> indexes it may use, checked with sequential scans disabled, a sequential scan anywhere in the plan fails
+PLAN_ASSERTIONS = [
+    (db._search_giveaway_queries['message_id'], (0,), ('giveaways_message_id_idx',)),
+    (db._need_rolling_query, (0, 50), ('giveaways_due_idx',)),
+    # the primary key is declared unique as well, so either of its indexes will do
+    (db._search_gate_query, (0, 0), ('giveaway_gates_pkey', 'giveaway_gates_id_key', 'giveaway_gates_channel_id_idx')),
+    ("""
+    SELECT count(*) FROM giveaway_participants WHERE giveaway_id=$1
+    """, (0,), ('giveaway_participants_pkey',)),
+]
+
+
+def plan_nodes(plan):
+    """
+    Flattens an EXPLAIN (FORMAT JSON) plan
+
+    :param plan: The plan node
+    :return: A list of every node of the plan
+    """
+    nodes = [plan]
+    for child in plan.get('Plans', []):
+        nodes.extend(plan_nodes(child))
+    return nodes
+
+
+class Suite:
+    def __init__(self, pool: asyncpg.pool.Pool):
+        self.pool = pool
+        self.giveaways = []
+        self.next_message_id = random.randrange(1 << 40, 1 << 50)
+
+    async def new_giveaway(self, length: int = 3600, starts_at: int = None, winner_count: int = 10,
+                           weights: dict = WEIGHTS):
+        ga_id = await db.create_giveaway(self.pool, CHANNEL_ID, length, 'benchmark', 0, winner_count, None,
+                                         REQUIRED_ROLES, starts_at, weights)
+        self.next_message_id += 1
+        await db.attach_giveaway_message(self.pool, ga_id, self.next_message_id)
+        self.giveaways.append(ga_id)
+        return ga_id, self.next_message_id
+
+    async def fill_participants(self, ga_id: int, count: int, weighted: bool):
+        records = [(ga_id, user_id, random.choice((1, 3)) if weighted else 1) for user_id in range(count)]
+        async with self.pool.acquire() as conn:
+            await conn.copy_records_to_table('giveaway_participants', records=records,
+                                             columns=('giveaway_id', 'user_id', 'weight'))
+
+    async def cleanup(self):
+        query = """
+        DELETE FROM giveaways WHERE id = ANY($1::int[])
+        """
+        await self.pool.execute(query, self.giveaways)
+        templates_query = """
+        DELETE FROM giveaway_gates_template WHERE id LIKE $1
+        """
+        await self.pool.execute(templates_query, TEMPLATE_PREFIX + '%')
+        for ga_id in self.giveaways:
+            db.registry.remove_giveaway(ga_id)
+            db.scheduler.cancel(ga_id)
+
+    async def reactions_per_second(self, reactions: int):
+        """
+        Calls bot.py's on_raw_reaction_add for reactions on a giveaway message, against a fake of the Discord REST
+        API, flushing the buffered writes whenever the buffer is full as the flush task would
+        """
+        ga_id, message_id = await self.new_giveaway()
+        members = {user_id: [random.choice(REQUIRED_ROLES + [99])] for user_id in range(100, 100 + reactions)}
+        Replay(self.pool, FakeREST()).setup_client(
+            {GUILD_ID: {'roles': set(REQUIRED_ROLES + [99]), 'channels': {CHANNEL_ID}, 'members': members}})
+        guild = sbz.bot.get_guild(GUILD_ID)
+        payloads = []
+        for user_id in members:
+            data = {'message_id': message_id, 'channel_id': CHANNEL_ID, 'user_id': user_id, 'guild_id': GUILD_ID,
+                    'type': 0, 'burst': False}
+            payload = discord.RawReactionActionEvent(data, discord.PartialEmoji.from_str(sbz.tada_emoji),
+                                                     'REACTION_ADD')
+            payload.member = guild.get_member(user_id)
+            payloads.append(payload)
+        start = time.perf_counter()
+        for payload in payloads:
+            await sbz.on_raw_reaction_add(payload)
+            if len(db.participant_writer.pending) >= db.participant_writer.max_pending:
+                await db.participant_writer.flush(self.pool)
+        await db.participant_writer.flush(self.pool)
+        duration = time.perf_counter() - start
+        # the DMs are only queued, nothing drains them here
+        sbz.bot.dm_outbox.pending.clear()
+        return reactions / duration
+
+    async def roll_ms(self, participants: int, rounds: int, weighted: bool):
+        ga_id, _ = await self.new_giveaway(weights=WEIGHTS if weighted else None)
+        await self.fill_participants(ga_id, participants, weighted)
+        timings = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            await db.roll_giveaway(self.pool, ga_id, reroll=True)
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings) * 1000
+
+    async def need_rolling_ms(self, open_giveaways: int, rounds: int):
+        now = int(time.time())
+        query = """
+        INSERT INTO giveaways (message_id, channel_id, created_at, length, winner_count, prize_name, host, requirements)
+        SELECT $1::bigint + n, $2, $3, 86400, 1, 'benchmark', 0, '{}' FROM generate_series(1, $4) n
+        RETURNING id
+        """
+        res = await self.pool.fetch(query, self.next_message_id, CHANNEL_ID, now, open_giveaways)
+        self.next_message_id += open_giveaways
+        self.giveaways.extend([i['id'] for i in res])
+        await self.pool.execute('ANALYZE giveaways')
+        timings = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            await db.get_need_rolling_giveaways(self.pool)
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings) * 1000
+
+    async def add_templates(self, templates: int):
+        """
+        Creates the templates parsed by `parse_requirements_ms`
+
+        :return: The requirements string, half template IDs and half aliases, mixed with raw role IDs
+        """
+        names = [f'{TEMPLATE_PREFIX}{i}' for i in range(templates)]
+        for i, name in enumerate(names):
+            await db.add_gate_template(self.pool, name, [1000 + i, 2000 + i])
+            await db.add_template_alias(self.pool, name, [f'{name}_alias'])
+        return ' '.join([name if i % 2 else f'{name}_alias' for i, name in enumerate(names)] + ['123', '456'])
+
+    async def parse_requirements_ms(self, raw: str, rounds: int, warm: bool):
+        db.template_cache.clear()
+        if warm:
+            await db.parse_requirements(self.pool, raw)
+        timings = []
+        for _ in range(rounds):
+            if not warm:
+                db.template_cache.clear()
+            start = time.perf_counter()
+            await db.parse_requirements(self.pool, raw)
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings) * 1000
+
+    async def assert_plans(self):
+        failures = []
+        async with self.pool.acquire() as conn:
+            await conn.execute('SET enable_seqscan = off')
+            for query, args, indexes in PLAN_ASSERTIONS:
+                plan = json.loads(await conn.fetchval(f'EXPLAIN (FORMAT JSON) {query}', *args))
+                nodes = plan_nodes(plan[0]['Plan'])
+                name = ' '.join(query.split())
+                if not any(node.get('Index Name') in indexes for node in nodes):
+                    failures.append(f'{name} does not use any of {", ".join(indexes)}')
+                if any(node['Node Type'] == 'Seq Scan' for node in nodes):
+                    failures.append(f'{name} does a sequential scan')
+            await conn.execute('RESET enable_seqscan')
+        return failures
+
+
+async def run(args):
+    pool = await asyncpg.create_pool(args.dsn)
+    await db.ensure_database_validity(pool)
+    suite = Suite(pool)
+    results = {}
+    try:
+        results['reactions_per_second'] = {'value': await suite.reactions_per_second(args.reactions),
+                                           'better': 'higher'}
+        for participants in args.roll_sizes:
+            for weighted in (False, True):
+                results[f'roll_{"weighted" if weighted else "flat"}_ms_{participants}'] = {
+                    'value': await suite.roll_ms(participants, args.rounds, weighted), 'better': 'lower'}
+        results['need_rolling_ms_10000_open'] = {'value': await suite.need_rolling_ms(10000, args.rounds),
+                                                 'better': 'lower'}
+        raw = await suite.add_templates(200)
+        for warm in (False, True):
+            results[f'parse_requirements_ms_{"warm" if warm else "cold"}'] = {
+                'value': await suite.parse_requirements_ms(raw, args.rounds, warm), 'better': 'lower'}
+        plan_failures = await suite.assert_plans() if args.explain else []
+    finally:
+        await suite.cleanup()
+        await pool.close()
+    return results, plan_failures
+
+
+def regressions(results: dict, baseline: dict, threshold: float):
+    ret = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]['value']
+        if result['better'] == 'higher':
+            regressed = result['value'] < old * (1 - threshold)
+        else:
+            regressed = result['value'] > old * (1 + threshold)
+        if regressed:
+            ret.append(f'{name} regressed from {old:.2f} to {result["value"]:.2f}')
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--output', help='Where to write the results as JSON')
+    parser.add_argument('--baseline', help='Results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed relative regression before failing, defaults to 0.2')
+    parser.add_argument('--reactions', type=int, default=20000)
+    parser.add_argument('--roll-sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--explain', action='store_true', help='Also assert the key queries can use their indexes')
+    args = parser.parse_args()
+    results, failures = asyncio.run(run(args))
+    for name, result in results.items():
+        print(f'{name:>32}: {result["value"]:.2f} ({result["better"]} is better)')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            failures.extend(regressions(results, json.loads(f.read()), args.threshold))
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
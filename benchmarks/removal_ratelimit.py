@@ -0,0 +1,67 @@
+"""
+Drives the reaction removal queue against a fake Discord REST API that answers over its per channel rate limit with
+429s, nothing goes over the network:
+    python -m benchmarks.removal_ratelimit --channels 4 --removals 40
+
+Exits with code 1 if a removal was lost or failed, if no 429 was hit, or if the queue sent a request to a channel
+before the time its 429 asked to wait for
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+import discord
+
+from benchmarks.fake_rest import BOT_USER_ID, RateLimitedREST, guild_payload, user_payload
+from removal_queue import RemovalBatch, ReactionRemovalQueue
+
+GUILD_ID = 1000
+
+
+async def run(args):
+    client = discord.Client(intents=discord.Intents.none())
+    rest = RateLimitedREST(args.limit, args.per)
+    client.http.request = rest.request
+    state = client._connection
+    state.user = discord.ClientUser(state=state, data=user_payload(BOT_USER_ID, bot=True))
+    channel_ids = [GUILD_ID + 1 + i for i in range(args.channels)]
+    state._add_guild_from_data(guild_payload(GUILD_ID, [], channel_ids, {}))
+    queue = ReactionRemovalQueue(client.get_channel, args.concurrency)
+    batch = RemovalBatch()
+    start = time.perf_counter()
+    for user_id in range(args.removals):
+        for channel_id in channel_ids:
+            queue.remove(channel_id, channel_id * 10, '\U0001f389', user_id + 10, batch=batch)
+    await batch.wait()
+    duration = time.perf_counter() - start
+    await client.close()
+    return batch, rest, queue, duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--removals', type=int, default=40, help='Removals per channel')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--limit', type=int, default=5, help='Requests allowed per channel per window')
+    parser.add_argument('--per', type=float, default=0.25, help='Rate limit window, in seconds')
+    args = parser.parse_args()
+    batch, rest, queue, duration = asyncio.run(run(args))
+    expected = args.channels * args.removals
+    print(f'{batch.done}/{expected} removals done, {batch.failed} failed in {duration:.2f}s, '
+          f'{rest.rate_limited} 429s, {queue.rate_limited} retries, {rest.violations} early retries')
+    failures = []
+    if batch.done != expected:
+        failures.append(f'{expected - batch.done} removals were not done')
+    if not rest.rate_limited:
+        failures.append('no removal was rate limited, raise --removals or lower --limit')
+    if rest.violations:
+        failures.append(f'{rest.violations} requests were sent before their retry_after')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""
+Replays events recorded with the `record_events` option of token.json against the bot's handlers, with a local
+fake of the Discord REST API and a scratch database, then reports handler latency, DB queries and REST calls per event
+
+Run it from the repository root, bot.py is imported and reads token.json like the bot does:
+    python -m benchmarks.replay events.jsonl --dsn postgresql://localhost/sbz_bench --speed 10
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import asyncpg
+import discord
+
+import bot as sbz
+import db
+from benchmarks.fake_rest import BOT_USER_ID, FakeREST, guild_payload, member_payload, user_payload
+from participant_writer import FLUSH_INTERVAL
+
+HANDLED_EVENTS = ('reaction_add', 'reaction_remove', 'member_join', 'member_remove', 'member_update')
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, record):
+        self.count += 1
+
+    async def init(self, conn):
+        conn.add_query_logger(self)
+
+
+def load_events(path: str):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def initial_guilds(events):
+    """
+    Rebuilds the guilds as they were when the recording started: every member seen, with the roles they had first
+
+    :param events: The recorded events
+    :return: A dict of guild ID to a dict with roles, channels and members (user ID to role IDs)
+    """
+    guilds = {}
+    channel_guilds = {}
+    for event in events:
+        if 'guild_id' not in event:
+            continue
+        guild = guilds.setdefault(event['guild_id'], {'roles': set(), 'channels': set(), 'members': {}})
+        roles = event.get('roles_before', event['roles'])
+        guild['roles'].update(roles)
+        guild['roles'].update(event['roles'])
+        if 'channel_id' in event:
+            guild['channels'].add(event['channel_id'])
+            channel_guilds[event['channel_id']] = event['guild_id']
+        if event['type'] == 'member_join':
+            # joined during the recording, they are added when replayed
+            guild['members'].setdefault(event['user_id'], None)
+        else:
+            guild['members'].setdefault(event['user_id'], roles)
+    for event in events:
+        if event['type'] in ('giveaway', 'gate') and event['channel_id'] in channel_guilds:
+            guilds[channel_guilds[event['channel_id']]]['roles'].update(event['requirements'])
+    for guild in guilds.values():
+        guild['members'] = {k: v for k, v in guild['members'].items() if v is not None}
+    return guilds
+
+
+class Replay:
+    def __init__(self, pool: asyncpg.pool.Pool, rest: FakeREST):
+        self.pool = pool
+        self.rest = rest
+        self.state = sbz.bot._connection
+        self.giveaways = []
+        self.gates = []
+        self.latencies = []
+
+    def setup_client(self, guilds: dict):
+        sbz.bot.http.request = self.rest.request
+        self.state.user = discord.ClientUser(state=self.state, data=user_payload(BOT_USER_ID, bot=True))
+        for guild_id, guild in guilds.items():
+            added = self.state._add_guild_from_data(
+                guild_payload(guild_id, guild['roles'], guild['channels'], guild['members']))
+            sbz.bot.role_index.load_guild(added)
+        sbz.bot.db = self.pool
+        sbz.bot.loaded_db = True
+        # the replay would otherwise record itself
+        sbz.bot.event_recorder = None
+
+    async def setup_targets(self, events):
+        await db.load_active_state(self.pool)
+        for event in events:
+            if event['type'] == 'giveaway':
+                existing = await db.search_giveaway(self.pool, 'message_id', event['message_id'])
+                if existing is not None:
+                    await db.delete_giveaway(self.pool, existing['id'])
+                ga_id = await db.create_giveaway(self.pool, event['channel_id'], 86400, 'replay', BOT_USER_ID, 1,
+                                                 None, event['requirements'], None, dict(event['weights']))
+                await db.attach_giveaway_message(self.pool, ga_id, event['message_id'])
+                self.giveaways.append(ga_id)
+            elif event['type'] == 'gate':
+                await db.remove_gate(self.pool, event['channel_id'], event['message_id'])
+                # the gate sweep is not replayed, it only has to outlive the replay
+                await db.add_gate(self.pool, event['channel_id'], event['message_id'],
+                                  max(event['remaining'], 3600), event['requirements'])
+                self.gates.append((event['channel_id'], event['message_id']))
+
+    async def cleanup(self):
+        for ga_id in self.giveaways:
+            await db.delete_giveaway(self.pool, ga_id)
+        for channel_id, message_id in self.gates:
+            await db.remove_gate(self.pool, channel_id, message_id)
+
+    async def dispatch(self, event, due: float):
+        guild = sbz.bot.get_guild(event['guild_id'])
+        if event['type'] in ('reaction_add', 'reaction_remove'):
+            data = {'message_id': event['message_id'], 'channel_id': event['channel_id'], 'user_id': event['user_id'],
+                    'guild_id': event['guild_id'], 'type': 0, 'burst': False}
+            payload = discord.RawReactionActionEvent(data, discord.PartialEmoji.from_str(event['emoji']),
+                                                     event['type'].upper())
+            if event['type'] == 'reaction_add':
+                payload.member = guild.get_member(event['user_id'])
+                await sbz.on_raw_reaction_add(payload)
+            else:
+                await sbz.on_raw_reaction_remove(payload)
+        elif event['type'] == 'member_join':
+            member = discord.Member(data=member_payload(event['user_id'], event['roles']), guild=guild,
+                                    state=self.state)
+            guild._add_member(member)
+            await sbz.on_member_join(member)
+        elif event['type'] == 'member_remove':
+            member = guild.get_member(event['user_id'])
+            if member is None:
+                return
+            guild._remove_member(member)
+            await sbz.on_member_remove(member)
+        elif event['type'] == 'member_update':
+            before = guild.get_member(event['user_id'])
+            if before is None:
+                return
+            after = discord.Member(data=member_payload(event['user_id'], event['roles']), guild=guild,
+                                   state=self.state)
+            guild._add_member(after)
+            await sbz.on_member_update(before, after)
+        self.latencies.append(time.perf_counter() - due)
+
+    async def run(self, events, speed: float):
+        start = time.perf_counter() + 0.5
+        dispatched = []
+        for event in events:
+            if event['type'] not in HANDLED_EVENTS:
+                continue
+            due = start + event['t'] / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            dispatched.append(asyncio.ensure_future(self.dispatch(event, due)))
+        await asyncio.gather(*dispatched)
+        return len(dispatched)
+
+    @staticmethod
+    def backlog():
+        return {'participants': len(db.participant_writer.pending), 'reaction_removals': len(sbz.bot.removal_queue),
+                'direct_messages': len(sbz.bot.dm_outbox.pending)}
+
+    async def drain(self, timeout: float):
+        """
+        Waits for the buffered writes, reaction removals and direct messages the events caused to be processed
+
+        :param timeout: The maximum amount of seconds to wait
+        :return: How long it took, in seconds
+        """
+        start = time.perf_counter()
+        while any(self.backlog().values()) and time.perf_counter() - start < timeout:
+            await asyncio.sleep(0.05)
+        return time.perf_counter() - start
+
+
+async def background(func):
+    # stands in for the task loops of bot.py, which only start once connected to the gateway
+    while True:
+        await func()
+
+
+async def flush_participants(pool: asyncpg.pool.Pool):
+    await db.participant_writer.wait(FLUSH_INTERVAL)
+    await db.participant_writer.flush(pool)
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': 0, 'p90': 0, 'p99': 0, 'max': 0}
+    cuts = statistics.quantiles(values * 2 if len(values) == 1 else values, n=100)
+    return {'p50': cuts[49], 'p90': cuts[89], 'p99': cuts[98], 'max': max(values)}
+
+
+async def run(args):
+    events = load_events(args.events)
+    counter = QueryCounter()
+    connect_kwargs = {'dsn': args.dsn} if args.dsn is not None else sbz.tokens['pgsql']
+    pool = await asyncpg.create_pool(**connect_kwargs, init=counter.init)
+    await db.ensure_database_validity(pool)
+    rest = FakeREST()
+    replay = Replay(pool, rest)
+    replay.setup_client(initial_guilds(events))
+    await replay.setup_targets(events)
+    workers = [asyncio.ensure_future(background(lambda: flush_participants(pool))),
+               asyncio.ensure_future(background(sbz.bot.dm_outbox.drain))]
+    queries_before = counter.count
+    try:
+        start = time.perf_counter()
+        count = await replay.run(events, args.speed)
+        duration = time.perf_counter() - start
+        drain_seconds = await replay.drain(args.drain_timeout)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await replay.cleanup()
+        await pool.close()
+    queries = counter.count - queries_before
+    return {
+        'events': count,
+        'speed': args.speed,
+        'replay_seconds': duration,
+        'events_per_second': count / duration if duration else 0,
+        'handler_latency_ms': {k: v * 1000 for k, v in percentiles(replay.latencies).items()},
+        'drain_seconds': drain_seconds,
+        'backlog_left': replay.backlog(),
+        'db_queries': queries,
+        'db_queries_per_event': queries / count if count else 0,
+        'rest_calls': rest.total,
+        'rest_calls_per_event': rest.total / count if count else 0,
+        'rest_calls_per_route': dict(rest.calls.most_common()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('events', help='The JSON lines file written by the recorder')
+    parser.add_argument('--dsn', default=None, help='Defaults to the pgsql section of token.json')
+    parser.add_argument('--speed', type=float, default=1, help='Replay speed multiplier, 1 to 50')
+    parser.add_argument('--drain-timeout', type=float, default=30,
+                        help='How long to wait for queued writes, removals and DMs after the last event')
+    parser.add_argument('--output', help='Where to write the report as JSON')
+    args = parser.parse_args()
+    if not 1 <= args.speed <= 50:
+        parser.error('--speed must be between 1 and 50')
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
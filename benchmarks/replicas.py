@@ -0,0 +1,130 @@
+"""
+Checks that several replicas rolling against one database never roll a giveaway twice, and elect a single leader
+
+Creates giveaways that have already ended, then starts --workers processes that each campaign for leadership and
+roll every due giveaway they can claim, like the check_giveaways safety net does:
+    python -m benchmarks.replicas --dsn postgresql://localhost/sbz_bench --workers 2 --giveaways 500
+
+Exits with code 1 if a giveaway was rolled by more than one worker, left unrolled, if two workers were leader at
+the same time or if none was
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+
+import asyncpg
+
+import db
+from leadership import Leadership
+
+
+async def create_ended_giveaways(pool: asyncpg.pool.Pool, count: int, participants: int):
+    ids = []
+    message_id = random.randrange(1 << 40, 1 << 50)
+    for i in range(count):
+        ga_id = await db.create_giveaway(pool, 0, 60, 'replicas', 0, 1, None, None, int(time.time()) - 120)
+        await db.attach_giveaway_message(pool, ga_id, message_id + i)
+        ids.append(ga_id)
+    query = """
+    INSERT INTO giveaway_participants (giveaway_id, user_id)
+    SELECT g, u FROM unnest($1::int[]) g, generate_series(1, $2) u
+    """
+    await pool.execute(query, ids, participants)
+    return ids
+
+
+async def track_leadership(leadership: Leadership, terms: list):
+    while True:
+        if leadership.is_leader:
+            if not terms or terms[-1][1] is not None:
+                terms.append([time.time(), None])
+        elif terms and terms[-1][1] is None:
+            terms[-1][1] = time.time()
+        await asyncio.sleep(0.05)
+
+
+async def worker(dsn: str, hold: float):
+    pool = await asyncpg.create_pool(dsn)
+    leadership = Leadership({'dsn': dsn}, interval=0.5)
+    await leadership.start()
+    terms = []
+    tracker = asyncio.ensure_future(track_leadership(leadership, terms))
+    rolled = []
+    while True:
+        need_rolling = await db.get_need_rolling_giveaways(pool)
+        if not need_rolling:
+            break
+        results = await asyncio.gather(*[db.roll_giveaway(pool, ga_id) for ga_id in need_rolling])
+        rolled.extend([ga_id for ga_id, res in zip(need_rolling, results) if res is not None])
+    # keep campaigning for a while, so the other workers see the lock held
+    await asyncio.sleep(hold)
+    tracker.cancel()
+    if terms and terms[-1][1] is None:
+        terms[-1][1] = time.time()
+    await leadership.close()
+    await pool.close()
+    print(json.dumps({'rolled': rolled, 'terms': terms}))
+
+
+async def run(args):
+    pool = await asyncpg.create_pool(args.dsn)
+    await db.ensure_database_validity(pool)
+    ids = await create_ended_giveaways(pool, args.giveaways, args.participants)
+    try:
+        processes = [subprocess.Popen([sys.executable, '-m', 'benchmarks.replicas', '--dsn', args.dsn, '--worker'],
+                                      stdout=subprocess.PIPE) for _ in range(args.workers)]
+        reports = [json.loads(process.communicate()[0].decode().strip().splitlines()[-1]) for process in processes]
+        query = """
+        SELECT count(*) FROM giveaways WHERE id = ANY($1::int[]) AND winners IS NULL
+        """
+        unrolled = await pool.fetchval(query, ids)
+    finally:
+        query = """
+        DELETE FROM giveaways WHERE id = ANY($1::int[])
+        """
+        await pool.execute(query, ids)
+        await pool.close()
+    return reports, unrolled
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--giveaways', type=int, default=500)
+    parser.add_argument('--participants', type=int, default=100)
+    parser.add_argument('--hold', type=float, default=2, help=argparse.SUPPRESS)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        asyncio.run(worker(args.dsn, args.hold))
+        return
+    reports, unrolled = asyncio.run(run(args))
+    failures = []
+    seen = {}
+    for number, report in enumerate(reports):
+        print(f'worker {number}: rolled {len(report["rolled"])}, leader for {len(report["terms"])} term(s)')
+        for ga_id in report['rolled']:
+            if ga_id in seen:
+                failures.append(f'giveaway {ga_id} rolled by workers {seen[ga_id]} and {number}')
+            seen[ga_id] = number
+    if unrolled:
+        failures.append(f'{unrolled} giveaways left unrolled')
+    # terms are sampled every 50ms, a handover within that window is not an overlap
+    terms = sorted([(start, end, number) for number, report in enumerate(reports) for start, end in report['terms']])
+    if not terms:
+        failures.append('no worker has been leader')
+    for previous, current in zip(terms, terms[1:]):
+        if current[0] < previous[1] - 0.05:
+            failures.append(f'workers {previous[2]} and {current[2]} have been leader at the same time')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Compares the flat and the weighted winner sampling of `db.roll_giveaway`
+
+Run it from the repository root against a scratch database, as it creates and deletes giveaways:
+    python -m benchmarks.roll_sampling --dsn postgresql://localhost/sbz_bench --participants 500000
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import asyncpg
+
+import db
+
+
+async def prepare_giveaway(pool: asyncpg.pool.Pool, participants: int, winners: int, weighted: bool):
+    weights = {1: 2, 2: 3} if weighted else None
+    ga_id = await db.create_giveaway(pool, 0, 3600, 'benchmark', 0, winners, weights=weights)
+    records = [(ga_id, user_id, random.choice((1, 2, 3)) if weighted else 1) for user_id in range(participants)]
+    async with pool.acquire() as conn:
+        await conn.copy_records_to_table('giveaway_participants', records=records,
+                                         columns=('giveaway_id', 'user_id', 'weight'))
+    return ga_id
+
+
+async def time_rolls(pool: asyncpg.pool.Pool, ga_id: int, rounds: int):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        await db.roll_giveaway(pool, ga_id, reroll=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+async def main(args):
+    pool = await asyncpg.create_pool(args.dsn)
+    await db.ensure_database_validity(pool)
+    for weighted in (False, True):
+        ga_id = await prepare_giveaway(pool, args.participants, args.winners, weighted)
+        try:
+            timings = await time_rolls(pool, ga_id, args.rounds)
+        finally:
+            await db.delete_giveaway(pool, ga_id)
+        print(f'{"weighted" if weighted else "flat":>8}: {args.participants} participants, {args.winners} winners, '
+              f'median {statistics.median(timings) * 1000:.1f}ms, max {max(timings) * 1000:.1f}ms')
+    await pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--participants', type=int, default=500000)
+    parser.add_argument('--winners', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
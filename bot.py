@@ -1,9 +1,12 @@
 import asyncio
 import datetime
+import functools
 import json
 import logging
+import os
 import random
 import re
+import tempfile
 import time
 import traceback
 import typing
@@ -11,32 +14,96 @@ import typing
 import aiohttp
 import asyncpg
 import discord
-import git
-import humanize
 from discord.ext import commands, tasks
 from discord.ext.commands import TextChannelConverter, BadArgument, MemberConverter
 
 import db
+import export
+from change_feed import ChangeFeed
+from dm_outbox import DirectMessageOutbox
+from event_recorder import EventRecorder
+from launcher import PROCESS_ENV, shard_ranges
+from leadership import SHARD_LOCK_KEY, Leadership
+from message_cache import MessageCache
+from metrics import Metrics
+from notice_ledger import NoticeLedger
+from participant_writer import FLUSH_INTERVAL
+from removal_queue import ReactionRemovalQueue, RemovalBatch
+from role_index import RoleIndex
+
+# (phase, time) marks of the cold start, reported once ready
+startup_marks = [('start', time.perf_counter())]
+
+
+def mark_startup(phase: str):
+    startup_marks.append((phase, time.perf_counter()))
 
 
 class SBZGiveawayBot(commands.Bot):
     def __init__(self, **options):
         super().__init__(**options)
         self.db = None
+        self.change_feed = None
+        self.leadership = None
+        self.shard_leadership = None
+        self.role_index = RoleIndex()
+        self.removal_queue = ReactionRemovalQueue(self.get_channel)
+        self.dm_outbox = DirectMessageOutbox()
+        self.notice_ledger = NoticeLedger()
+        self.message_cache = MessageCache()
+        self.metrics = Metrics()
+        self.event_recorder = None
         self.loaded_db = False
 
+    async def setup_hook(self):
+        # task loops and extensions need the running event loop, which only exists once the bot is started
+        start_background_tasks()
+        # only used for debugging
+        await self.load_extension('jishaku')
+
+
+class SBZGiveawayShardedBot(SBZGiveawayBot, commands.AutoShardedBot):
+    """
+    Cluster mode variant, each process started by launcher.py owns a range of shards
+    """
+
 
-intents = discord.Intents.all()
 logging.basicConfig(level=logging.WARNING)
-bot = SBZGiveawayBot(command_prefix='g$', intents=intents)
-bot.load_extension('jishaku')
 tada_emoji = '\U0001f389'
-repo = git.Repo('.')
-bot.msg_sent = {}
 
 with open('token.json', 'r') as f:
     tokens = json.loads(f.read())
 
+intents = discord.Intents.all()
+cluster_process = int(os.environ.get(PROCESS_ENV, 0))
+if 'cluster' in tokens:
+    # {"shard_count": 8, "processes": 2}, reactions and gates are handled by the process owning the guild,
+    # rolling is done by a single leader process
+    shard_ids = shard_ranges(tokens['cluster']['shard_count'], tokens['cluster']['processes'])[cluster_process]
+    bot = SBZGiveawayShardedBot(command_prefix='g$', intents=intents, shard_ids=shard_ids,
+                                shard_count=tokens['cluster']['shard_count'])
+else:
+    bot = SBZGiveawayBot(command_prefix='g$', intents=intents)
+
+if 'metrics' in tokens:
+    # {"host": "127.0.0.1", "port": 9100}, db timings and loop timings are only recorded when configured
+    bot.metrics.enable()
+    bot.metrics.instrument_module(db)
+if 'record_events' in tokens:
+    # path of a JSON lines file to append raw reaction and member events to, replayable with benchmarks.replay
+    bot.event_recorder = EventRecorder(tokens['record_events'], db.registry)
+
+
+@functools.lru_cache(maxsize=None)
+def git_version():
+    """
+    Resolves the short hash of the running commit, once, GitPython is only imported then
+
+    :return: The first 8 characters of the commit hash
+    """
+    import git
+    return git.Repo('.').head.object.hexsha[:8]
+
 
 def convert_time(raw):
     """
@@ -63,22 +130,90 @@ def convert_time(raw):
 async def on_connect():
     if not bot.loaded_db:
         logging.warning('LOADED DATABASE')
+        mark_startup('gateway')
         bot.db = await asyncpg.create_pool(**tokens['pgsql'])
+        mark_startup('pool')
         await db.ensure_database_validity(bot.db)
+        mark_startup('schema')
+        stale = await db.delete_stale_reservations(bot.db, int(time.time()) - STALE_RESERVATION_AGE)
+        if stale:
+            logging.warning(f'Deleted {stale} giveaway reservations whose message was never sent')
+        await db.load_active_state(bot.db)
+        await bot.notice_ledger.load(bot.db)
+        mark_startup('preload')
+        bot.change_feed = ChangeFeed(tokens['pgsql'], db.apply_change, lambda: db.load_active_state(bot.db))
+        await bot.change_feed.start()
+        bot.leadership = Leadership(tokens['pgsql'])
+        await bot.leadership.start()
+        bot.shard_leadership = Leadership(tokens['pgsql'], key=SHARD_LOCK_KEY + cluster_process)
+        await bot.shard_leadership.start()
+        if bot.metrics.enabled:
+            await bot.metrics.start(**tokens['metrics'])
         bot.loaded_db = True
+        mark_startup('services')
     logging.warning('Connected')
 
 
 @bot.event
 async def on_ready():
+    for guild in bot.guilds:
+        bot.role_index.load_guild(guild)
     logging.warning('Ready')
+    if startup_marks[-1][0] != 'ready':
+        mark_startup('ready')
+        phases = ', '.join([f'{phase} {end - start:.2f}s'
+                            for (_, start), (phase, end) in zip(startup_marks, startup_marks[1:])])
+        total = startup_marks[-1][1] - startup_marks[0][1]
+        logging.warning(f'Cold start took {total:.2f}s: {phases}')
+        bot.metrics.set('sbz_cold_start_seconds', total)
+        asyncio.ensure_future(reconcile_on_startup())
+
+
+@bot.event
+async def on_guild_join(guild):
+    bot.role_index.load_guild(guild)
+
+
+@bot.event
+async def on_member_join(member):
+    if bot.event_recorder is not None:
+        bot.event_recorder.member_join(member)
+    bot.role_index.add_member(member)
+
+
+@bot.event
+async def on_member_remove(member):
+    if bot.event_recorder is not None:
+        bot.event_recorder.member_remove(member)
+    bot.role_index.remove_member(member)
+
+
+@bot.event
+async def on_member_update(before, after):
+    if bot.event_recorder is not None:
+        bot.event_recorder.member_update(before, after)
+    bot.role_index.update_member(before, after)
+    for gate in db.registry.verified_gates(after.id):
+        if db.meets_requirements(gate['requirements'], after):
+            continue
+        for emoji in gate['verified'].pop(after.id, ()):
+            bot.removal_queue.remove(gate['channel_id'], gate['id'], emoji, after.id)
+            giveaway = db.registry.get_giveaway(gate['id'])
+            # the removal is not reported back as a leave, as it is the bot's own
+            if emoji == tada_emoji and giveaway is not None and giveaway['winners'] is None:
+                db.participant_writer.leave(giveaway['id'], after.id)
+
+
+@bot.event
+async def on_guild_role_delete(role):
+    bot.role_index.remove_role(role.guild.id, role.id)
 
 
 @bot.event
 async def on_command_error(ctx, error):
     traceback.print_exception(type(error), error, error.__traceback__)
     traceback_data = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
-    version = repo.head.object.hexsha[:8]
+    version = git_version()
     params = {'exc_string': str(error), 'exc_content': traceback_data,
               'time': int(time.time()), 'msg_author_name': str(ctx.author), 'msg_author_id': str(ctx.author.id),
               'msg_guild_name': ctx.guild.name,
@@ -93,94 +228,329 @@ async def on_command_error(ctx, error):
     await ctx.send(f'Oh crap, something went VERY WRONG, the exception has been recorded at {track_url}')
 
 
-@tasks.loop(hours=12)
-async def clear_msg_sent():
-    bot.msg_sent = {}
+@tasks.loop(minutes=10)
+async def log_message_cache_stats():
+    if bot.message_cache.avoided:
+        logging.warning(f'Message fetches avoided per call site: {bot.message_cache.stats()}')
 
 
-@tasks.loop(seconds=1)
-async def check_giveaways():
-    await bot.wait_until_ready()
+@tasks.loop(seconds=30)
+async def save_notice_ledger():
     if not bot.loaded_db:
-        # bot hasn't loaded DB yet
         return
-    need_rolling = await db.get_need_rolling_giveaways(bot.db)
-    if len(need_rolling) == 0:
-        pass
-    else:
-        for ga_id in need_rolling:
-            try:
-                winners = await db.roll_winner(bot.db, ga_id)
-            except db.NoParticipants:
-                details = await db.get_info_of_giveaway(bot.db, ga_id)
-                embed = discord.Embed(title=details['prize_name'],
-                                      description='No one has joined the giveaway, thus the roll has been canceled',
-                                      colour=discord.Colour.dark_red())
-                embed.add_field(name='Hosted By', value=details['host'])
-                if details['image'] is not None:
-                    embed.set_image(url=details['image'])
-                embed.timestamp = datetime.datetime.utcfromtimestamp(details['created_at'] + details['length'])
-                embed.set_footer(text=f'ID: {ga_id}| Ended At')
-                cc = bot.get_channel(details['channel_id'])
-                mc = await cc.fetch_message(details['message_id'])
-                await mc.edit(embed=embed)
-                await cc.send(
-                    f'Giveaway of {details["prize_name"]} (ID:{str(ga_id)}) has been canceled, due to no participants in the giveaway')
-                continue
-            except db.NotEnoughParticipants:
-                details = await db.get_info_of_giveaway(bot.db, ga_id)
-                embed = discord.Embed(title=details['prize_name'],
-                                      description=f'Not enough people joined the giveaway (only {len(details["participants"])}), thus the roll has been canceled',
-                                      colour=discord.Colour.dark_red())
-                embed.add_field(name='Hosted By', value=f'<@!{details["host"]}>')
-                if details['image'] is not None:
-                    embed.set_image(url=details['image'])
-                embed.timestamp = datetime.datetime.utcfromtimestamp(details['created_at'] + details['length'])
-                embed.set_footer(text=f'ID: {ga_id}| Ended At')
-                cc = bot.get_channel(details['channel_id'])
-                mc = await cc.fetch_message(details['message_id'])
-                await mc.edit(embed=embed)
-                await cc.send(
-                    f'Giveaway of {details["prize_name"]} (ID:{str(ga_id)}) has been canceled, due to not enough people joined the giveaway (only {len(details["participants"])})')
-                continue
-            details = await db.get_info_of_giveaway(bot.db, ga_id)
+    try:
+        await bot.notice_ledger.save(bot.db)
+    except Exception as error:
+        # unsaved notices are kept by the ledger, keep the task alive and retry on the next save
+        logging.error('Saving the notice ledger has failed')
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+
+roll_workers = asyncio.Semaphore(5)
+
+
+async def finalize_giveaway(ga_id):
+    async with roll_workers:
+        details = await db.roll_giveaway(bot.db, ga_id)
+        if details is None:
+            # already rolled by the other path
+            return
+        embed = discord.Embed(title=details['prize_name'])
+        embed.add_field(name='Hosted By', value=f'<@!{details["host"]}>')
+        if details['participant_count'] == 0:
+            embed.description = 'No one has joined the giveaway, thus the roll has been canceled'
+            embed.colour = discord.Colour.dark_red()
+            announcement = f'Giveaway of {details["prize_name"]} (ID:{str(ga_id)}) has been canceled, due to no participants in the giveaway'
+        elif details['participant_count'] < details['winner_count']:
+            embed.description = f'Not enough people joined the giveaway (only {details["participant_count"]}), thus the roll has been canceled'
+            embed.colour = discord.Colour.dark_red()
+            announcement = f'Giveaway of {details["prize_name"]} (ID:{str(ga_id)}) has been canceled, due to not enough people joined the giveaway (only {details["participant_count"]})'
+        else:
             winners_ping = [f'<@!{i}>' for i in details['winners']]
-            embed = discord.Embed(title=details['prize_name']
-                                  )
-            embed.add_field(name='Hosted By', value=f'<@!{details["host"]}>')
             if details['requirements']:
                 req_ping = [f'<@&{i}>' for i in details['requirements']]
                 embed.add_field(name='Requirements (Match one of them)', value=', '.join(req_ping))
-            embed.add_field(name='Winner' + ('s' if len(winners) >= 2 else ''), value=', '.join(winners_ping))
-            if details['image'] is not None:
-                embed.set_image(url=details['image'])
-            embed.timestamp = datetime.datetime.utcfromtimestamp(details['created_at'] + details['length'])
-            embed.set_footer(text=f'ID: {ga_id}| Ended At')
-            cc = bot.get_channel(details['channel_id'])
-            mc = await cc.fetch_message(details['message_id'])
-            await mc.edit(embed=embed)
-            await cc.send(
-                f'Giveaway of {details["prize_name"]} (ID:{str(ga_id)}) has been rolled, winners: {" ".join(winners_ping)}\nCongratulations!')
+            embed.add_field(name='Winner' + ('s' if len(winners_ping) >= 2 else ''), value=', '.join(winners_ping))
+            announcement = f'Giveaway of {details["prize_name"]} (ID:{str(ga_id)}) has been rolled, winners: {" ".join(winners_ping)}\nCongratulations!'
+        if details['image'] is not None:
+            embed.set_image(url=details['image'])
+        embed.timestamp = datetime.datetime.utcfromtimestamp(details['ends_at'])
+        embed.set_footer(text=f'ID: {ga_id}| Ended At')
+        # the leader may not own the guild of the giveaway in cluster mode, REST calls work from any shard
+        cc = bot.get_partial_messageable(details['channel_id'])
+        mc = bot.message_cache.partial(cc, details['message_id'], 'check_giveaways')
+        await asyncio.gather(mc.edit(embed=embed), cc.send(announcement))
+
+
+async def roll_giveaways(need_rolling):
+    results = await asyncio.gather(*[finalize_giveaway(ga_id) for ga_id in need_rolling], return_exceptions=True)
+    for ga_id, result in zip(need_rolling, results):
+        if isinstance(result, Exception):
+            logging.error(f'Rolling giveaway {ga_id} has failed')
+            traceback.print_exception(type(result), result, result.__traceback__)
+
+
+@tasks.loop(seconds=0)
+async def run_scheduler():
+    # only the leader rolls on time, the other replicas keep their schedule up to date through the change feed
+    await bot.leadership.wait_elected()
+    due = await db.scheduler.wait_due()
+    if not due:
+        return
+    await roll_giveaways(due)
+
+
+@run_scheduler.before_loop
+async def before_run_scheduler():
+    await bot.wait_until_ready()
+
+
+@tasks.loop(minutes=1)
+@bot.metrics.timed_loop('check_giveaways', 60)
+async def check_giveaways():
+    # safety net for giveaways the scheduler has missed, the scheduler does the rolling on time
+    # runs on every replica, rolls are claimed row by row so they split a backlog instead of rolling twice
+    if not bot.loaded_db:
+        # bot hasn't loaded DB yet
+        return
+    need_rolling = await db.get_need_rolling_giveaways(bot.db)
+    if len(need_rolling) != 0:
+        await roll_giveaways(need_rolling)
+
+
+@check_giveaways.before_loop
+async def before_check_giveaways():
+    await bot.wait_until_ready()
+
+
+@tasks.loop(seconds=0)
+async def flush_participants():
+    await db.participant_writer.wait(FLUSH_INTERVAL)
+    if not bot.loaded_db:
+        return
+    try:
+        await db.participant_writer.flush(bot.db)
+    except Exception as error:
+        # events are requeued by the writer, keep the task alive and retry on the next flush
+        logging.error('Flushing participants has failed')
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+
+@tasks.loop(seconds=0)
+async def drain_dm_outbox():
+    await bot.dm_outbox.drain()
+
+
+@drain_dm_outbox.before_loop
+async def before_drain_dm_outbox():
+    await bot.wait_until_ready()
+
+
+@tasks.loop(seconds=0)
+async def sample_metrics():
+    await bot.metrics.sample(bot.db if bot.loaded_db else None)
+
+
+# a reaction is cleared as a whole instead of user by user when at least this many reactors,
+# and at least this fraction of them, have to be removed
+BULK_CLEAR_MIN = 50
+BULK_CLEAR_FRACTION = 0.5
+# expired gates left unswept for this long, in seconds, are dropped without a sweep
+ORPHAN_GATE_GRACE = 600
+# reservations without a message for this long, in seconds, are deleted on startup, a send takes far less
+STALE_RESERVATION_AGE = 600
+
+
+async def remove_unqualified_reactions(msg: discord.Message, requirements, known=(), batch=None):
+    """
+    Queues the removal of the reactions of everyone on the message who does not have one of the required roles
+    Reactions where most reactors are disqualified are cleared at once, qualified reactors keep their gate
+    verification, only their visible reaction is gone, giveaway messages are never cleared at once
+    Qualified reactors of a gate whose reaction is kept are recorded as verified
+
+    :param msg: The message to check the reactions of
+    :param requirements: A list of role IDs
+    :param known: IDs of reactors already known to qualify, they are skipped
+    :param batch: The :class:`RemovalBatch` to report progress to, a new one is created if not provided
+    :return: The amount of disqualified reactors, and the batch of the removals
+    """
+    if batch is None:
+        batch = RemovalBatch()
+    giveaway = db.registry.get_giveaway(msg.id)
+    # clearing gives no per-user events, the participants of a giveaway would be left in, and reconciliation would
+    # later drop the qualified ones whose reaction is gone
+    bulk = giveaway is None
+    if giveaway is not None and giveaway['winners'] is not None:
+        giveaway = None
+    disqualified_count = 0
+    for i in msg.reactions:
+        reactors = set()
+        async for ii in i.users():
+            if not ii.bot:
+                reactors.add(ii.id)
+        # users who left the guild are not in the index, thus never qualified
+        if bot.role_index.is_indexed(msg.guild.id):
+            qualified = bot.role_index.qualified(msg.guild.id, requirements)
+        else:
+            # the guild is still being chunked, reactors not cached yet are left alone
+            members = {user_id: msg.guild.get_member(user_id) for user_id in reactors}
+            qualified = {user_id for user_id, member in members.items()
+                         if member is None or db.meets_requirements(requirements, member)}
+        disqualified = reactors - set(known) - qualified
+        disqualified_count += len(disqualified)
+        if bulk and len(disqualified) >= BULK_CLEAR_MIN and len(disqualified) >= BULK_CLEAR_FRACTION * len(reactors):
+            bot.removal_queue.clear(msg.channel.id, msg.id, i.emoji, readd=i.me, batch=batch)
+            continue
+        # recorded as verified, so the final sweep of a gate does not check them again
+        for user_id in reactors - disqualified:
+            db.registry.verify_reaction(msg.channel.id, msg.id, user_id, str(i.emoji))
+        for user_id in disqualified:
+            bot.removal_queue.remove(msg.channel.id, msg.id, i.emoji, user_id, batch=batch)
+            # the removal is not reported back as a leave, as it is the bot's own
+            if giveaway is not None and str(i.emoji) == tada_emoji:
+                db.participant_writer.leave(giveaway['id'], user_id)
+    return disqualified_count, batch
+
+
+async def report_removal_progress(ctx: commands.Context, batch: RemovalBatch):
+    if batch.finished:
+        return
+    status = await ctx.send(f'Removing reactions... 0/{batch.total}')
+    while not batch.finished:
+        try:
+            await asyncio.wait_for(batch.wait(), 10)
+        except asyncio.TimeoutError:
+            await status.edit(content=f'Removing reactions... {batch.done + batch.failed}/{batch.total}')
+    await status.edit(content=f'Removed reactions, {batch.done}/{batch.total} done'
+                              + (f', {batch.failed} failed' if batch.failed else ''))
+
+
+async def _next_or_none(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def _tada_reactors(msg: discord.Message):
+    # paginated with after=, in ascending user ID order like the stored participants
+    reaction = discord.utils.get(msg.reactions, emoji=tada_emoji)
+    if reaction is None:
+        return
+    async for user in reaction.users():
+        if not user.bot:
+            yield user
+
+
+async def reconcile_giveaway(giveaway):
+    """
+    Brings the stored participants of a giveaway back in line with its reactors, eg. after the bot was offline
+    Reactors and participants are both streamed in ascending user ID order and merged, so only the differences are
+    held in memory, reactors who do not meet the requirements have their reaction removed instead of being added
+
+    :param giveaway: A record with id, message_id, channel_id, requirements, weight_roles and weights
+    :return: The amount of participants added, removed, and of reactions rejected
+    """
+    channel = bot.get_channel(giveaway['channel_id'])
+    msg = await bot.message_cache.fetch(channel, giveaway['message_id'], 'reconcile')
+    weights = dict(zip(giveaway['weight_roles'] or [], giveaway['weights'] or []))
+    # events buffered before the reactors are read are written first, the ones arriving meanwhile are newer
+    await db.participant_writer.flush(bot.db, giveaway['id'])
+    stored = db.iter_participants(bot.db, giveaway['id'])
+    next_stored = await _next_or_none(stored)
+    joins = {}
+    leaves = []
+    rejected = 0
+    async for user in _tada_reactors(msg):
+        while next_stored is not None and next_stored < user.id:
+            leaves.append(next_stored)
+            next_stored = await _next_or_none(stored)
+        if next_stored == user.id:
+            next_stored = await _next_or_none(stored)
+            continue
+        member = msg.guild.get_member(user.id)
+        if member is not None and db.meets_requirements(giveaway['requirements'], member):
+            joins[user.id] = (db.entry_weight(weights, member), db.qualifying_role(giveaway['requirements'], member))
+        else:
+            bot.removal_queue.remove(msg.channel.id, msg.id, tada_emoji, user.id)
+            rejected += 1
+    while next_stored is not None:
+        leaves.append(next_stored)
+        next_stored = await _next_or_none(stored)
+    pending = {user_id for giveaway_id, user_id in db.participant_writer.pending if giveaway_id == giveaway['id']}
+    joins = {k: v for k, v in joins.items() if k not in pending}
+    leaves = [i for i in leaves if i not in pending]
+    await db.apply_participant_diff(bot.db, giveaway['id'], joins, leaves)
+    return len(joins), len(leaves), rejected
+
+
+async def reconcile_giveaways(giveaway_id: int = None):
+    """
+    Reconciles the active giveaways the process can see, one at a time
+
+    :param giveaway_id: Only reconcile this giveaway (Optional)
+    :return: The total amount of participants added, removed, and of reactions rejected
+    """
+    totals = [0, 0, 0]
+    for giveaway in await db.get_active_giveaways(bot.db):
+        if giveaway_id is not None and giveaway['id'] != giveaway_id:
+            continue
+        if bot.get_channel(giveaway['channel_id']) is None:
+            # owned by another process in cluster mode, or the channel is gone
+            continue
+        try:
+            res = await reconcile_giveaway(giveaway)
+        except discord.HTTPException:
+            logging.warning(f'Reconciliation of giveaway {giveaway["id"]} has failed')
+            continue
+        totals = [a + b for a, b in zip(totals, res)]
+    return tuple(totals)
+
+
+async def reconcile_on_startup():
+    try:
+        joined, left, rejected = await reconcile_giveaways()
+    except Exception as error:
+        logging.error('Startup reconciliation has failed')
+        traceback.print_exception(type(error), error, error.__traceback__)
+        return
+    logging.warning(f'Startup reconciliation: {joined} participants added, {left} removed, {rejected} rejected')
 
 
 @tasks.loop(seconds=1)
+@bot.metrics.timed_loop('invalidate_and_check_ongoing_gates', 1)
 async def invalidate_and_check_ongoing_gates():
+    # reactors are checked as they react and re-checked as their roles change,
+    # the final sweep only covers those whose state is unknown, eg. reacted while the bot was offline
     if not bot.loaded_db:
         return
-    await db.clear_expired_gates(bot.db)
-    for iiiii in await db.get_ending_soon_gates(bot.db):
-        msg = await bot.get_channel(int(iiiii['channel_id'])).fetch_message(int(iiiii['id']))
-        for i in msg.reactions:
-            async for ii in i.users():
-                if ii.bot:
-                    continue
-                if isinstance(ii, discord.User):
-                    await i.remove(ii)
-                    continue
-                ii_roles = [iii.id for iii in ii.roles]
-                if not any(iii in ii_roles for iii in iiiii['requirements']):
-                    await i.remove(ii)
-                    logging.info(f'Removed {str(ii.id)} from {str(iiiii["id"])}')
+    now = int(time.time())
+    if bot.leadership.is_leader and db.registry.expired_gates(now - ORPHAN_GATE_GRACE):
+        # gates no process can sweep, eg. in a deleted channel
+        await db.clear_expired_gates(bot.db, now - ORPHAN_GATE_GRACE)
+    if not bot.shard_leadership.is_leader:
+        return
+    # reactors' roles are only known to the process owning the guild, so each process sweeps its own gates
+    expired = [gate for gate in db.registry.expired_gates(now) if bot.get_channel(gate['channel_id']) is not None]
+    if not expired:
+        return
+    for gate in expired:
+        channel = bot.get_channel(gate['channel_id'])
+        if channel is None:
+            logging.warning(f'Channel of gate {gate["id"]} has been deleted, skipping its final sweep')
+            continue
+        try:
+            msg = await bot.message_cache.fetch(channel, gate['id'], 'gate_sweep')
+            await remove_unqualified_reactions(msg, gate['requirements'], gate['verified'].keys())
+        except (discord.NotFound, discord.Forbidden) as error:
+            logging.warning(f'Gate {gate["id"]} can no longer be swept, skipping its final sweep: {error}')
+        except discord.HTTPException:
+            logging.warning(f'Final sweep of gate {gate["id"]} has failed')
+        except Exception as error:
+            # one broken gate must not stop the loop for the others
+            logging.error(f'Final sweep of gate {gate["id"]} has failed')
+            traceback.print_exception(type(error), error, error.__traceback__)
+    await db.clear_expired_gates(bot.db, now, [gate['id'] for gate in expired])
 
 
 @check_giveaways.error
@@ -193,6 +563,56 @@ class Canceled(Exception):
     pass
 
 
+async def send_giveaway_message(channel: discord.TextChannel, giveaway_id: int, embed: discord.Embed):
+    """
+    Sends the message of a reserved giveaway and attaches it, if either fails the message and the reservation are
+    deleted, so neither is left behind untracked
+
+    :param channel: The channel to send the message in
+    :param giveaway_id: The ID of the reserved giveaway
+    :param embed: The embed of the giveaway message
+    :return: The sent message
+    """
+    sent = None
+    try:
+        sent = await channel.send(embed=embed)
+        await db.attach_giveaway_message(bot.db, giveaway_id, sent.id)
+    except (Exception, asyncio.CancelledError):
+        if sent is not None:
+            try:
+                await sent.delete()
+            except discord.HTTPException:
+                logging.warning(f'Could not delete the message of giveaway {giveaway_id}, {sent.jump_url}')
+        try:
+            await db.delete_giveaway(bot.db, giveaway_id)
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+            # left to the startup sweep
+            logging.warning(f'Could not release the reservation of giveaway {giveaway_id}')
+        raise
+    return sent
+
+
+def parse_weights(raw):
+    """
+    Parse bonus entries (eg. 123:2 456:3) into a dict of role ID to weight
+
+    :param raw: Space separated role_id:entries pairs
+    :raises ValueError: If a pair is malformed or its entries is not positive
+    :return: A dict of role ID to weight
+    """
+    weights = {}
+    for pair in raw.split(' '):
+        role_id, weight = pair.split(':')
+        if int(weight) < 1:
+            raise ValueError(f'Entries of {role_id} must be positive')
+        weights[int(role_id)] = int(weight)
+    return weights
+
+
+def format_weights(weights):
+    return ', '.join([f'<@&{role_id}> x{weight}' for role_id, weight in weights.items()])
+
+
 @bot.command(name='new', usage='new', description='Launches an interactive session of creating a new giveaway')
 @commands.has_any_role(593163327304237098, 764541727494504489, 637823625558229023, 598197239688724520)
 async def new_giveaway(ctx):
@@ -211,6 +631,7 @@ async def new_giveaway(ctx):
             f'Channel will be {channel.mention}\n\n2.How long should the giveaway last for? (suffixes: w-week d-day h-hour, m-minute, s-second)')
         msg = await bot.wait_for('message', check=check, timeout=240)
         length = convert_time(msg.content)
+        import humanize
         await ctx.send(
             f'It will last for {humanize.naturaltime(length, future=True).rstrip(" from now")}\n\n3. How many winners should there be?')
         msg = await bot.wait_for('message', check=check, timeout=240)
@@ -245,29 +666,36 @@ async def new_giveaway(ctx):
         else:
             req_ping = None
         await ctx.send(
-            f'Please validate your selections:\n\nCHN {channel.mention}\nLGT `{length}`\nWNC `{winner_count}`\nPZN `{prize_name}`\nIMG `{image}`\nHST {host.mention}\nREQ {", ".join(req_ping) if req_ping is not None else "None"}\n\nType `yes` to start the giveaway',
+            f'Requirements will be {", ".join(req_ping) if req_ping is not None else "None"}\n\n8. Give any roles bonus entries? (Type in role_id:entries pairs, separate them in space, eg. `123:2 456:3`, type none or n if there isn\'t any)',
+            allowed_mentions=discord.AllowedMentions.none())
+        msg = await bot.wait_for('message', check=check, timeout=240)
+        if msg.content.lower() == 'none' or msg.content.lower() == 'n':
+            weights = None
+        else:
+            weights = parse_weights(msg.content)
+        await ctx.send(
+            f'Please validate your selections:\n\nCHN {channel.mention}\nLGT `{length}`\nWNC `{winner_count}`\nPZN `{prize_name}`\nIMG `{image}`\nHST {host.mention}\nREQ {", ".join(req_ping) if req_ping is not None else "None"}\nBON {format_weights(weights) if weights else "None"}\n\nType `yes` to start the giveaway',
             allowed_mentions=discord.AllowedMentions.none())
         msg = await bot.wait_for('message', check=check, timeout=240)
         if 'y' not in msg.content:
             raise InterruptedError
-        next_id = await db.get_next_id(bot.db)
         creation_time = int(time.time())
+        next_id = await db.create_giveaway(bot.db, channel.id, length, prize_name, host.id, winner_count, image,
+                                           requirements, creation_time, weights)
         embed = discord.Embed(title=prize_name,
                               colour=discord.Colour.from_rgb(random.randint(0, 255), random.randint(0, 255),
                                                              random.randint(0, 255)))
         embed.add_field(name='Hosted By', value=host.mention)
         if requirements is not None:
             embed.add_field(name='Requirements (Match one of them)', value=', '.join(req_ping))
+        if weights:
+            embed.add_field(name='Bonus Entries', value=format_weights(weights))
         embed.add_field(name='Winners', value=str(winner_count))
         if image is not None:
             embed.set_image(url=image)
         embed.timestamp = datetime.datetime.utcfromtimestamp(creation_time + length)
         embed.set_footer(text=f'ID: {next_id}| Ends At')
-        sent = await channel.send(embed=embed)
-        sent_ctx = await bot.get_context(sent)
-        await db.create_giveaway(bot.db, next_id, sent_ctx, length, prize_name, host.id, winner_count, image,
-                                 requirements,
-                                 creation_time)
+        sent = await send_giveaway_message(channel, next_id, embed)
         await sent.add_reaction(tada_emoji)
     except asyncio.TimeoutError:
         await ctx.send('Timed out, all inputs have been discarded.')
@@ -275,15 +703,14 @@ async def new_giveaway(ctx):
         await ctx.send('Canceled, all inputs have been discarded')
     except BadArgument:
         await ctx.send('Channel or host invalid, terminating interactive session, all inputs have been discarded')
+    except ValueError:
+        await ctx.send('Bonus entries invalid, terminating interactive session, all inputs have been discarded')
     except InterruptedError:
         await ctx.send('Last validation did not pass, terminating interactive session, all inputs have been discarded')
 
 
-async def send_message_if_needed(guild, gates, member):
-    if gates['id'] not in bot.msg_sent:
-        bot.msg_sent[gates['id']] = []
-    if member.id not in bot.msg_sent[gates['id']]:
-        bot.msg_sent[gates['id']].append(member.id)
+def send_message_if_needed(guild, gates, member):
+    if bot.notice_ledger.should_notify(gates['id'], member.id):
         embed = discord.Embed(title='\u274c**|**Giveaway Participation Attempt Failed',
                               colour=discord.Colour.red())
         req_roles = [guild.get_role(iiii) for iiii in gates['requirements']]
@@ -292,61 +719,117 @@ async def send_message_if_needed(guild, gates, member):
         embed.add_field(name='You can check the following spreadsheet to learn how to get them: ',
                         value='https://docs.google.com/document/d/1r4rs_7KsopvFD99SQUKYteLjkXiJcI5jwlW5QNZFfgE',
                         inline=False)
-        await member.send(embed=embed)
+        bot.dm_outbox.send(member, embed=embed, key=('denied', gates['id']))
+
+
+@bot.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    bot.message_cache.invalidate(payload.channel_id, payload.message_id)
+
+
+@bot.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    for message_id in payload.message_ids:
+        bot.message_cache.invalidate(payload.channel_id, message_id)
+
+
+@bot.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    bot.message_cache.invalidate(int(payload.data['channel_id']), payload.message_id)
+
+
+@bot.event
+async def on_raw_reaction_clear(payload: discord.RawReactionClearEvent):
+    bot.message_cache.invalidate(payload.channel_id, payload.message_id)
+
+
+@bot.event
+async def on_raw_reaction_clear_emoji(payload: discord.RawReactionClearEmojiEvent):
+    bot.message_cache.invalidate(payload.channel_id, payload.message_id)
 
 
 @bot.event
 async def on_raw_reaction_add(payload: discord.RawReactionActionEvent):
+    bot.metrics.inc('sbz_reaction_events_total', event='add')
+    if bot.event_recorder is not None:
+        bot.event_recorder.reaction(payload, payload.member)
+    bot.message_cache.on_reaction_add(payload.channel_id, payload.message_id, str(payload.emoji))
     if payload.user_id == bot.user.id:
         return
-    giveaway = await db.search_giveaway(bot.db, 'message_id', payload.message_id)
-    gates = await db.search_gate(bot.db, payload.channel_id, payload.message_id)
+    if not db.registry.is_tracked(payload.message_id):
+        return
+    giveaway = db.registry.get_giveaway(payload.message_id)
+    gates = db.registry.get_gate(payload.channel_id, payload.message_id)
     if giveaway is None and gates is None:
         return
     if gates is not None:
         guild = bot.get_guild(payload.guild_id)
-        member = guild.get_member(payload.user_id)
-        roles = [iii.id for iii in member.roles]
-        if not any(iii in roles for iii in gates['requirements']):
-            message = await bot.get_channel(gates['channel_id']).fetch_message(gates['id'])
-            for i in message.reactions:
-                i: discord.Reaction
-                if str(payload.emoji) == str(i.emoji):
-                    await i.remove(bot.get_user(payload.user_id))
-                    if member is None:
-                        pass
-                    else:
-                        await send_message_if_needed(guild, gates, member)
-                    logging.info(f'Removed {str(payload.user_id)} from {str(payload.message_id)}')
+        member = payload.member or guild.get_member(payload.user_id)
+        if bot.role_index.is_indexed(payload.guild_id):
+            qualified = bot.role_index.is_qualified(payload.guild_id, payload.user_id, gates['requirements'])
+        elif member is not None:
+            # the guild is still being chunked, its index is only complete once ready
+            qualified = db.meets_requirements(gates['requirements'], member)
+        else:
+            return
+        if qualified:
+            db.registry.verify_reaction(payload.channel_id, payload.message_id, payload.user_id, str(payload.emoji))
+        else:
+            bot.removal_queue.remove(payload.channel_id, payload.message_id, payload.emoji, payload.user_id)
+            if member is not None:
+                send_message_if_needed(guild, gates, member)
+            # the removal is the bot's own and is not reported back as a leave, so the user must not join
+            return
         if giveaway is None:
             return
         if giveaway['winners'] is not None:
             return
     member = bot.get_guild(payload.guild_id).get_member(payload.user_id)
-    res = await db.add_participant(bot.db, giveaway['id'], member)
-    msg = await bot.get_guild(payload.guild_id).get_channel(payload.channel_id).fetch_message(payload.message_id)
-    msg: discord.Message
+    if member is None:
+        return
+    res = db.meets_requirements(giveaway['requirements'], member)
+    if res:
+        db.participant_writer.join(giveaway['id'], member.id, db.entry_weight(giveaway['weights'], member),
+                                   db.qualifying_role(giveaway['requirements'], member))
+    jump_url = f'https://discord.com/channels/{payload.guild_id}/{payload.channel_id}/{payload.message_id}'
     if not res:
-        await msg.remove_reaction(tada_emoji, member)
-        await member.send(
-            f'Your attempt on participating in the giveaway at {msg.jump_url} has been denied, due to the insufficient requirements you meet')
+        bot.removal_queue.remove(payload.channel_id, payload.message_id, tada_emoji, member.id)
+        bot.dm_outbox.send(
+            member,
+            f'Your attempt on participating in the giveaway at {jump_url} has been denied, due to the insufficient requirements you meet',
+            key=('denied', payload.message_id))
     else:
-        await member.send(f'You have successfully participated in the giveaway at {msg.jump_url}')
+        bot.dm_outbox.send(member, f'You have successfully participated in the giveaway at {jump_url}',
+                           key=('participation', payload.message_id))
 
 
 @bot.event
 async def on_raw_reaction_remove(payload: discord.RawReactionActionEvent):
+    bot.metrics.inc('sbz_reaction_events_total', event='remove')
+    if bot.event_recorder is not None:
+        guild = bot.get_guild(payload.guild_id)
+        bot.event_recorder.reaction(payload, guild.get_member(payload.user_id) if guild is not None else None)
     if payload.user_id == bot.user.id:
         return
-    giveaway = await db.search_giveaway(bot.db, 'message_id', payload.message_id)
+    if not db.registry.is_tracked(payload.message_id):
+        return
+    db.registry.unverify_reaction(payload.channel_id, payload.message_id, payload.user_id, str(payload.emoji))
+    giveaway = db.registry.get_giveaway(payload.message_id)
     if giveaway is None:
         return
     if giveaway['winners'] is not None:
         return
+    # reactions the bot removes are of users who were denied, or who are made to leave where they are removed
+    if bot.removal_queue.initiated(payload.channel_id, payload.message_id, payload.emoji, payload.user_id):
+        return
+    db.participant_writer.leave(giveaway['id'], payload.user_id)
     member = bot.get_guild(payload.guild_id).get_member(payload.user_id)
-    await db.remove_participant(bot.db, giveaway['id'], member)
-    await member.send(
-        f'You have successfully unparticipated the giveaway at https://discord.com/channels/{payload.guild_id}/{payload.channel_id}/{payload.message_id}')
+    if member is None:
+        return
+    bot.dm_outbox.send(
+        member,
+        f'You have successfully unparticipated the giveaway at https://discord.com/channels/{payload.guild_id}/{payload.channel_id}/{payload.message_id}',
+        key=('participation', payload.message_id))
     return
 
 
@@ -356,9 +839,14 @@ async def reroll(ctx: commands.Context, giveaway_id: int):
     ga = await db.search_giveaway(bot.db, 'id', giveaway_id)
     if ga is None:
         await ctx.send(f'Reroll failed, giveaway ID {giveaway_id} does not exist')
+        return
     chn = ctx.guild.get_channel(ga['channel_id'])
-    msg = await chn.fetch_message(ga['message_id'])
-    new_winners = await db.roll_winner(bot.db, giveaway_id)
+    msg = bot.message_cache.partial(chn, ga['message_id'], 'reroll')
+    try:
+        new_winners = await db.roll_winner(bot.db, giveaway_id)
+    except (db.RollUnavailable, db.NoParticipants, db.NotEnoughParticipants) as error:
+        await ctx.send(f'Reroll failed, {str(error).lower()}')
+        return
     winners_ping = [f'<@!{str(i)}>' for i in new_winners]
     embed = discord.Embed(title=ga['prize_name'] + ' (Rerolled)'
                           )
@@ -396,8 +884,9 @@ async def quick(ctx: commands.Context, channel: discord.TextChannel, length: typ
     await ctx.send(
         f'Giveaway will be created with the following parameters:\n\nCHN {channel.mention}\nLGT `{length}`\nWNC `{winner_count}`\nPZN `{prize_name}`',
         allowed_mentions=discord.AllowedMentions.none())
-    next_id = await db.get_next_id(bot.db)
     creation_time = int(time.time())
+    next_id = await db.create_giveaway(bot.db, channel.id, length, prize_name, host.id, winner_count, None, [],
+                                       creation_time)
     embed = discord.Embed(title=prize_name,
                           colour=discord.Colour.from_rgb(random.randint(0, 255), random.randint(0, 255),
                                                          random.randint(0, 255)))
@@ -405,11 +894,7 @@ async def quick(ctx: commands.Context, channel: discord.TextChannel, length: typ
     embed.add_field(name='Winners', value=str(winner_count))
     embed.timestamp = datetime.datetime.utcfromtimestamp(creation_time + length)
     embed.set_footer(text=f'ID: {next_id}| Ends At')
-    sent = await channel.send(embed=embed)
-    sent_ctx = await bot.get_context(sent)
-    await db.create_giveaway(bot.db, next_id, sent_ctx, length, prize_name, host.id, winner_count, None,
-                             [],
-                             creation_time)
+    sent = await send_giveaway_message(channel, next_id, embed)
     await sent.add_reaction(tada_emoji)
 
 
@@ -420,57 +905,32 @@ async def gate(ctx):
         'You shall be using some other commands, instead of this one, think about what you could have done in this 3 seconds typing and wating for this message to appear...')
 
 
-async def parse_requirements(requirements: str):
-    requirements = requirements.split(' ')
-    new_reqs = []
-    for req in requirements:
-        if isinstance(req, str):
-            if not req.isdigit():
-                res = await db.get_gate_template(bot.db, req)
-                if res is not None:
-                    new_reqs.extend(res)
-            else:
-                new_reqs.append(int(req))
-        else:
-            new_reqs.append(req)
-    return new_reqs
-
-
 @gate.command(name='add', usage='gate add <channel> <message_id> <interval> <requirements>',
               description='Adds a requirement gate to the message, reacting any reactions on the message without matching the requirements will be denied and have it removed\nInterval formats as <amount><suffix> where available suffixes are w,d,h,m,s\nRequirements shall be splited with spaces')
 @commands.has_any_role(593163327304237098, 764541727494504489, 637823625558229023, 598197239688724520)
 async def add(ctx: commands.Context, channel: discord.TextChannel, message_id: int, interval: str, *,
               requirements: str):
     interval = int(convert_time(interval))
-    requirements = await parse_requirements(requirements)
+    requirements = await db.parse_requirements(bot.db, requirements)
     try:
         await db.add_gate(bot.db, channel.id, message_id, interval, requirements)
     except asyncpg.UniqueViolationError:
         await ctx.send('There has been already a gate on this message')
         return
-    msg = await channel.fetch_message(message_id)
+    msg = await bot.message_cache.fetch(channel, message_id, 'gate_add')
     req_ping = [f'<@&{i}>' for i in requirements]
     await ctx.send(
         f'Gate added, with the following roles: {" ".join(req_ping)}, existing illegal reactions are being removed',
         allowed_mentions=discord.AllowedMentions.none())
-    for i in msg.reactions:
-        async for ii in i.users():
-            if ii.bot:
-                continue
-            if isinstance(ii, discord.User):
-                await i.remove(ii)
-                continue
-            ii_roles = [iii.id for iii in ii.roles]
-            if not any(iii in ii_roles for iii in requirements):
-                await i.remove(ii)
-                logging.info(f'Removed {str(ii.id)} from {str(message_id)}')
+    _, batch = await remove_unqualified_reactions(msg, requirements)
+    await report_removal_progress(ctx, batch)
 
 
 @gate.command(name='modify', usage='gate modify <channel> <message_id> <new_requirements>',
               description='Changes the requirement gate of message to new_requirements')
 @commands.has_any_role(593163327304237098, 764541727494504489, 637823625558229023, 598197239688724520)
 async def modify(ctx: commands.Context, channel: discord.TextChannel, message_id: int, new_requirements: str):
-    pr = await parse_requirements(new_requirements)
+    pr = await db.parse_requirements(bot.db, new_requirements)
     await db.modify_gate(bot.db, channel.id, message_id, pr)
     req_ping = [f'<@&{i}>' for i in pr]
     await ctx.send(f'Gate modified, with the new requirements: {" ".join(req_ping)}',
@@ -487,23 +947,11 @@ async def remove(ctx: commands.Context, channel: discord.TextChannel, message_id
 @gate.command(name='qualifycheck', usage='gate qualifycheck <channel> <message_id>')
 @commands.has_any_role(593163327304237098, 764541727494504489, 637823625558229023, 598197239688724520)
 async def qualifycheck(ctx: commands.Context, channel: discord.TextChannel, message_id: int):
-    msg = await channel.fetch_message(message_id)
-    bombarded = 0
+    msg = await bot.message_cache.fetch(channel, message_id, 'qualifycheck')
     requirements = (await db.search_gate(bot.db, channel.id, message_id))['requirements']
-    for i in msg.reactions:
-        async for ii in i.users():
-            if ii.bot:
-                continue
-            if isinstance(ii, discord.User):
-                await i.remove(ii)
-                bombarded += 1
-                continue
-            ii_roles = [iii.id for iii in ii.roles]
-            if not any(iii in ii_roles for iii in requirements):
-                await i.remove(ii)
-                bombarded += 1
-                logging.info(f'Removed {str(ii.id)} from {str(message_id)}')
+    bombarded, batch = await remove_unqualified_reactions(msg, requirements)
     await ctx.send(f'{bombarded} users have lost their chance to the giveaway, feelin\' good')
+    await report_removal_progress(ctx, batch)
 
 
 @gate.command(name='bombard', usage='bombard',
@@ -512,24 +960,13 @@ async def qualifycheck(ctx: commands.Context, channel: discord.TextChannel, mess
 async def bombard(ctx: commands.Context):
     gates = await db.list_gates(bot.db)
     messages = []
+    batch = RemovalBatch()
     for gate in gates:
-        bombarded = 0
-        msg = await bot.get_channel(gate['channel_id']).fetch_message(gate['id'])
-        for i in msg.reactions:
-            async for ii in i.users():
-                if ii.bot:
-                    continue
-                if isinstance(ii, discord.User):
-                    await i.remove(ii)
-                    bombarded += 1
-                    continue
-                ii_roles = [iii.id for iii in ii.roles]
-                if not any(iii in ii_roles for iii in gate['requirements']):
-                    await i.remove(ii)
-                    bombarded += 1
-                    logging.info(f'Removed {str(ii.id)} from {str(msg.id)}')
-        messages.append(f'Removed {bombarded} people from {msg.jump_url}')
+        msg = await bot.message_cache.fetch(bot.get_channel(gate['channel_id']), gate['id'], 'bombard')
+        bombarded, _ = await remove_unqualified_reactions(msg, gate['requirements'], batch=batch)
+        messages.append(f'Removing {bombarded} people from {msg.jump_url}')
     await ctx.send('\n'.join(messages))
+    await report_removal_progress(ctx, batch)
 
 
 @gate.command(name='purgeinvalid', usage='purgeinvalid', description='Pruges invalid gates', aliases=['pi'])
@@ -538,7 +975,7 @@ async def purge_invalid(ctx):
     removed = []
     for gate in gates:
         try:
-            await bot.get_channel(gate['channel_id']).fetch_message(gate['id'])
+            await bot.message_cache.fetch(bot.get_channel(gate['channel_id']), gate['id'], 'purge_invalid')
         except discord.NotFound:
             await db.remove_gate(bot.db, gate['channel_id'], gate['id'])
             removed.append(
@@ -556,7 +993,7 @@ async def template(ctx):
 @template.command(name='add', usage='add <template_id> <roles>')
 @commands.has_any_role(615756323589718046, 606228008134639636, 590693437922344960, 637823625558229023)
 async def add_template(ctx: commands.Context, template_id: str, *, roles: str):
-    roles = await parse_requirements(roles)
+    roles = await db.parse_requirements(bot.db, roles)
     await db.add_gate_template(bot.db, template_id, roles)
     res = await db.get_gate_template(bot.db, template_id)
     await ctx.send(
@@ -590,7 +1027,7 @@ async def unalias(ctx: commands.Context, template_id: str, *, aliases: str):
 @commands.has_any_role(615756323589718046, 606228008134639636, 590693437922344960, 637823625558229023)
 async def addrole(ctx: commands.Context, template_id: str, *, roles: str):
     await db.purge_template_invalid_roles(bot.db, ctx.guild, template_id)
-    roles = await parse_requirements(roles)
+    roles = await db.parse_requirements(bot.db, roles)
     for role in roles:
         await db.add_template_role(bot.db, template_id, role)
     res = await db.get_gate_template(bot.db, template_id)
@@ -603,7 +1040,7 @@ async def addrole(ctx: commands.Context, template_id: str, *, roles: str):
 @commands.has_any_role(615756323589718046, 606228008134639636, 590693437922344960, 637823625558229023)
 async def rmrole(ctx: commands.Context, template_id: str, *, roles: str):
     await db.purge_template_invalid_roles(bot.db, ctx.guild, template_id)
-    roles = await parse_requirements(roles)
+    roles = await db.parse_requirements(bot.db, roles)
     for role in roles:
         await db.remove_template_role(bot.db, template_id, role)
     res = await db.get_gate_template(bot.db, template_id)
@@ -634,13 +1071,78 @@ async def template_list(ctx: commands.Context):
         await ctx.send(msg, allowed_mentions=discord.AllowedMentions.none())
 
 
+@bot.command(name='reconcile', usage='reconcile [giveaway_id]',
+             description='Syncs the participants of the active giveaways, or of one giveaway, with their reactions')
+@commands.is_owner()
+async def reconcile(ctx, giveaway_id: int = None):
+    await ctx.send('Reconciling participants...')
+    joined, left, rejected = await reconcile_giveaways(giveaway_id)
+    await ctx.send(f'Reconciled, {joined} participants added, {left} removed, {rejected} reactions rejected')
+
+
+@bot.command(name='export', usage='export <giveaway_id> [csv|jsonl]',
+             description='Exports the participants of the giveaway, with their entry time and qualifying role, '
+                         'as a gzipped file')
+@commands.has_any_role(593163327304237098, 764541727494504489, 637823625558229023, 598197239688724520)
+async def export_participants(ctx, giveaway_id: int, fmt: str = 'csv'):
+    if fmt not in export.FORMATS:
+        await ctx.send(f'Export failed, format must be one of {", ".join(export.FORMATS)}')
+        return
+    ga = await db.search_giveaway(bot.db, 'id', giveaway_id)
+    if ga is None:
+        await ctx.send(f'Export failed, giveaway ID {giveaway_id} does not exist')
+        return
+    # spooled to disk, so a large giveaway never sits in memory
+    with tempfile.TemporaryFile() as f:
+        count = await export.write_export(bot.db, giveaway_id, f, fmt)
+        if f.tell() > ctx.guild.filesize_limit:
+            await ctx.send(f'Export of {count} participants is too large to upload, '
+                           f'run `python export.py {giveaway_id} --format {fmt}` on the host instead')
+            return
+        f.seek(0)
+        await ctx.send(f'Exported {count} participants of giveaway ID {giveaway_id}',
+                       file=discord.File(f, filename=f'giveaway-{giveaway_id}.{fmt}.gz'))
+
+
+@bot.command(name='registrystats', usage='registrystats',
+             description='Shows the size and hit/miss counters of the active message registry')
+@commands.is_owner()
+async def registrystats(ctx):
+    stats = db.registry.stats()
+    await ctx.send(f'Giveaways: `{stats["giveaways"]}`\nGates: `{stats["gates"]}`\n'
+                   f'Hits: `{stats["hits"]}`\nMisses: `{stats["misses"]}`')
+
+
 @bot.command(name='reboot')
 @commands.is_owner()
 async def reboot(ctx):
     await ctx.send('Shutting down...')
+    await db.participant_writer.flush(bot.db)
+    await bot.notice_ledger.save(bot.db)
+    await bot.metrics.stop()
+    await bot.leadership.close()
+    await bot.shard_leadership.close()
+    if bot.event_recorder is not None:
+        bot.event_recorder.close()
     await bot.close()
 
 
-check_giveaways.start()
-invalidate_and_check_ongoing_gates.start()
-bot.run(tokens['token'])
+def start_background_tasks():
+    check_giveaways.start()
+    run_scheduler.start()
+    flush_participants.start()
+    drain_dm_outbox.start()
+    save_notice_ledger.start()
+    log_message_cache_stats.start()
+    invalidate_and_check_ongoing_gates.start()
+    if bot.metrics.enabled:
+        sample_metrics.start()
+
+
+def main():
+    bot.run(tokens['token'])
+
+
+# importable without connecting, benchmarks.replay drives the handlers directly
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import logging
+
+import asyncpg
+
+CHANNEL = 'sbz_giveaway_changes'
+
+
+class ChangeFeed:
+    """
+    Dedicated LISTEN connection applying the change notifications sent by the triggers created in
+    `db.ensure_database_validity` to the local caches
+    On reconnection `on_reconnect` is awaited, as notifications sent while disconnected are lost
+    """
+
+    def __init__(self, connect_kwargs: dict, on_change, on_reconnect=None):
+        """
+        :param connect_kwargs: Keyword arguments for :func:`asyncpg.connect`
+        :param on_change: Called with every decoded change, a dict with table, op and row
+        :param on_reconnect: Coroutine function awaited after the connection had to be re-established (Optional)
+        """
+        self.connect_kwargs = connect_kwargs
+        self.on_change = on_change
+        self.on_reconnect = on_reconnect
+        self.conn = None
+        self._closed = False
+        self._reconnecting = None
+
+    async def start(self):
+        """
+        Opens the listening connection
+
+        :return: None
+        """
+        self.conn = await asyncpg.connect(**self.connect_kwargs)
+        self.conn.add_termination_listener(self._terminated)
+        await self.conn.add_listener(CHANNEL, self._notified)
+
+    async def close(self):
+        """
+        Closes the listening connection without reconnecting
+
+        :return: None
+        """
+        self._closed = True
+        if self.conn is not None:
+            await self.conn.close()
+
+    def _notified(self, conn, pid, channel, payload):
+        try:
+            self.on_change(json.loads(payload))
+        except Exception:
+            logging.exception(f'Failed to apply change {payload}')
+
+    def _terminated(self, conn):
+        if self._closed or self._reconnecting is not None:
+            return
+        self._reconnecting = asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self):
+        delay = 1
+        listening = False
+        while not self._closed:
+            # the new connection may drop during the resync, its termination is not reported while reconnecting
+            listening = listening and not self.conn.is_closed()
+            try:
+                if not listening:
+                    await self.start()
+                    listening = True
+                    logging.warning('Change feed reconnected')
+                if self.on_reconnect is not None:
+                    await self.on_reconnect()
+            except Exception as error:
+                # a connection opened without its listener would never be noticed as missing
+                if not listening and self.conn is not None and not self.conn.is_closed():
+                    self.conn.terminate()
+                logging.warning(f'Change feed reconnection failed, retrying in {delay}s: {error!r}')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+                continue
+            break
+        self._reconnecting = None
+        if not self._closed and self.conn.is_closed():
+            self._terminated(self.conn)
@@ -1,9 +1,23 @@
-import random
+import json
+import secrets
 import time
 
 import asyncpg
 import discord
-from discord.ext import commands
+
+from participant_writer import FLUSH_INTERVAL, ParticipantWriter
+from registry import ActiveMessageRegistry
+from scheduler import GiveawayScheduler
+
+registry = ActiveMessageRegistry()
+# giveaways are rolled this long after they end, in seconds, so the joins other replicas still buffer are written,
+# it covers their flush interval, the flush itself and whole second end times
+ROLL_GRACE = FLUSH_INTERVAL + 1.75
+participant_writer = ParticipantWriter()
+scheduler = GiveawayScheduler(ROLL_GRACE)
+_secure_random = secrets.SystemRandom()
+# template ID or alias -> roles, cleared on any template change
+template_cache = {}
 
 
 class NotEnoughParticipants(Exception):
@@ -16,23 +30,78 @@ class NoParticipants(Exception):
         super().__init__('No participants have participated in this giveaway')
 
 
+class RollUnavailable(Exception):
+    def __init__(self):
+        super().__init__('This giveaway does not exist or is being rolled by another worker')
+
+
 class NotParticipated(Exception):
     def __init__(self):
         super().__init__('The requested removal object did not participated in this giveaway')
 
 
+# advisory lock key serializing schema updates between processes starting together
+SCHEMA_LOCK_KEY = 95827437
+# bump whenever _ensure_schema changes, the schema is only updated when the stored version differs
+SCHEMA_VERSION = 2
+
+
+async def get_schema_version(conn: asyncpg.Connection):
+    """
+    Fetches the version of the schema the database has been updated to
+
+    :param conn: The connection to use
+    :return: The version, None if the database has never been versioned
+    """
+    query = """
+    SELECT version FROM giveaway_schema_version
+    """
+    try:
+        return await conn.fetchval(query)
+    except asyncpg.UndefinedTableError:
+        return None
+
+
 async def ensure_database_validity(db: asyncpg.pool.Pool):
     """
-    Ensures the database table is valid
+    Ensures the database table is valid, one process at a time
+    Does nothing but checking the schema version if it is up to date
 
     :param db: The database object
     :return: None
     """
+    async with db.acquire() as conn:
+        if await get_schema_version(conn) == SCHEMA_VERSION:
+            return
+        await conn.execute('SELECT pg_advisory_lock($1)', SCHEMA_LOCK_KEY)
+        try:
+            # another process may have updated it while waiting for the lock
+            if await get_schema_version(conn) == SCHEMA_VERSION:
+                return
+            await _ensure_schema(db)
+            version_query = """
+            CREATE TABLE IF NOT EXISTS giveaway_schema_version
+            (
+                id      bool primary key default true check (id),
+                version int not null
+            );
+            """
+            await conn.execute(version_query)
+            set_version_query = """
+            INSERT INTO giveaway_schema_version (version) VALUES ($1)
+            ON CONFLICT (id) DO UPDATE SET version=EXCLUDED.version
+            """
+            await conn.execute(set_version_query, SCHEMA_VERSION)
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock($1)', SCHEMA_LOCK_KEY)
+
+
+async def _ensure_schema(db: asyncpg.pool.Pool):
     query = """
     CREATE TABLE IF NOT EXISTS giveaways
     (
-        id           int unique    not null primary key,
-        message_id   bigint        not null,
+        id           int generated by default as identity primary key,
+        message_id   bigint,
         channel_id   bigint        not null,
         created_at   bigint        not null,
         length       bigint        not null,
@@ -41,11 +110,56 @@ async def ensure_database_validity(db: asyncpg.pool.Pool):
         image        text,
         host         bigint        not null,
         requirements bigint[],
-        participants bigint[],
         winners      bigint[]
     );
     """
     await db.execute(query)
+    await migrate_giveaway_identity(db)
+    weights_query = """
+    ALTER TABLE giveaways
+        ADD COLUMN IF NOT EXISTS weight_roles bigint[],
+        ADD COLUMN IF NOT EXISTS weights      int[]
+    """
+    await db.execute(weights_query)
+    ends_at_query = """
+    ALTER TABLE giveaways ADD COLUMN IF NOT EXISTS ends_at bigint GENERATED ALWAYS AS (created_at + length) STORED
+    """
+    await db.execute(ends_at_query)
+    due_index_query = """
+    CREATE INDEX IF NOT EXISTS giveaways_due_idx ON giveaways (ends_at) WHERE winners IS NULL
+    """
+    await db.execute(due_index_query)
+    message_index_query = """
+    CREATE UNIQUE INDEX IF NOT EXISTS giveaways_message_id_idx ON giveaways (message_id)
+    """
+    await db.execute(message_index_query)
+    participants_query = """
+    CREATE TABLE IF NOT EXISTS giveaway_participants
+    (
+        giveaway_id int    not null references giveaways (id) on delete cascade,
+        user_id     bigint not null,
+        weight      int    not null default 1,
+        primary key (giveaway_id, user_id)
+    );
+    """
+    await db.execute(participants_query)
+    participant_weight_query = """
+    ALTER TABLE giveaway_participants ADD COLUMN IF NOT EXISTS weight int not null default 1
+    """
+    await db.execute(participant_weight_query)
+    # added without a default first, so the entry time of existing participants stays unknown instead of now
+    participant_entry_query = """
+    ALTER TABLE giveaway_participants
+        ADD COLUMN IF NOT EXISTS joined_at       bigint,
+        ADD COLUMN IF NOT EXISTS qualifying_role bigint
+    """
+    await db.execute(participant_entry_query)
+    # before the default is set, participants moved from the legacy array have no known entry time either
+    await migrate_participants_array(db)
+    participant_entry_default_query = """
+    ALTER TABLE giveaway_participants ALTER COLUMN joined_at SET DEFAULT extract(epoch FROM now())::bigint
+    """
+    await db.execute(participant_entry_default_query)
     gates_query = """
     CREATE TABLE IF NOT EXISTS giveaway_gates
     (
@@ -56,6 +170,10 @@ async def ensure_database_validity(db: asyncpg.pool.Pool):
     );
     """
     await db.execute(gates_query)
+    gates_index_query = """
+    CREATE INDEX IF NOT EXISTS giveaway_gates_channel_id_idx ON giveaway_gates (channel_id, id)
+    """
+    await db.execute(gates_index_query)
     gates_template_query = """
     CREATE TABLE IF NOT EXISTS giveaway_gates_template
     (
@@ -65,55 +183,308 @@ async def ensure_database_validity(db: asyncpg.pool.Pool):
     );
     """
     await db.execute(gates_template_query)
+    template_alias_index_query = """
+    CREATE INDEX IF NOT EXISTS giveaway_gates_template_alias_idx ON giveaway_gates_template USING gin (alias)
+    """
+    await db.execute(template_alias_index_query)
+    notices_query = """
+    CREATE TABLE IF NOT EXISTS giveaway_notices
+    (
+        gate_id    bigint not null,
+        user_id    bigint not null,
+        expires_at bigint not null,
+        primary key (gate_id, user_id)
+    );
+    """
+    await db.execute(notices_query)
+    await ensure_change_triggers(db)
 
 
-async def get_next_id(db: asyncpg.pool.Pool):
+async def ensure_change_triggers(db: asyncpg.pool.Pool):
     """
-    Get the next giveaway ID
+    Creates the triggers that NOTIFY every change of giveaways, gates and gate templates on the
+    `sbz_giveaway_changes` channel, used by other processes to keep their caches in sync
 
     :param db: The database object
-    :return: The next giveaway ID to be used as an int
+    :return: None
+    """
+    function_query = """
+    CREATE OR REPLACE FUNCTION sbz_giveaway_notify_change() RETURNS trigger AS $$
+    DECLARE
+        data jsonb;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            data := to_jsonb(OLD);
+        ELSE
+            data := to_jsonb(NEW);
+        END IF;
+        IF TG_TABLE_NAME = 'giveaways' THEN
+            data := jsonb_build_object('id', data->'id', 'message_id', data->'message_id',
+                                       'requirements', data->'requirements', 'ends_at', data->'ends_at',
+                                       'weight_roles', data->'weight_roles', 'weights', data->'weights',
+                                       'rolled', jsonb_typeof(data->'winners') = 'array');
+        END IF;
+        PERFORM pg_notify('sbz_giveaway_changes',
+                          jsonb_build_object('table', TG_TABLE_NAME, 'op', TG_OP, 'row', data)::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """
+    await db.execute(function_query)
+    for table in ('giveaways', 'giveaway_gates', 'giveaway_gates_template'):
+        async with db.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(f"""
+                DROP TRIGGER IF EXISTS {table}_notify_change ON {table}
+                """)
+                await conn.execute(f"""
+                CREATE TRIGGER {table}_notify_change AFTER INSERT OR UPDATE OR DELETE ON {table}
+                FOR EACH ROW EXECUTE PROCEDURE sbz_giveaway_notify_change()
+                """)
+
+
+def apply_change(change: dict):
+    """
+    Applies a change notification from another process to the in-memory registry, scheduler and template cache
+
+    :param change: The decoded notification, a dict with table, op and row
+    :return: None
+    """
+    row = change['row']
+    if change['table'] == 'giveaways':
+        if change['op'] == 'DELETE' or row['rolled'] or row['message_id'] is None:
+            registry.remove_giveaway(row['id'])
+            scheduler.cancel(row['id'])
+        else:
+            registry.add_giveaway({'id': row['id'], 'message_id': row['message_id'],
+                                   'requirements': row['requirements'], 'winners': None,
+                                   'weight_roles': row['weight_roles'], 'weights': row['weights']})
+            scheduler.schedule(row['id'], row['ends_at'])
+    elif change['table'] == 'giveaway_gates':
+        if change['op'] == 'DELETE':
+            registry.remove_gate(row['channel_id'], row['id'])
+        else:
+            registry.add_gate(row)
+    elif change['table'] == 'giveaway_gates_template':
+        template_cache.clear()
+
+
+async def migrate_participants_array(db: asyncpg.pool.Pool):
+    """
+    Moves participants from the legacy `giveaways.participants` array column into `giveaway_participants`
+    Duplicated entries in the array are collapsed, the legacy column is dropped afterwards
+    The array did not record when participants joined, so their entry time is left unknown
+
+    :param db: The database object
+    :return: None
     """
     query = """
-    SELECT id FROM giveaways ORDER BY id DESC LIMIT 1
+    SELECT 1 FROM information_schema.columns WHERE table_name='giveaways' AND column_name='participants'
+    """
+    if not await db.fetch(query):
+        return
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            migrate_query = """
+            INSERT INTO giveaway_participants (giveaway_id, user_id, joined_at)
+            SELECT id, unnest(participants), NULL FROM giveaways WHERE participants IS NOT NULL
+            ON CONFLICT DO NOTHING
+            """
+            await conn.execute(migrate_query)
+            drop_query = """
+            ALTER TABLE giveaways DROP COLUMN participants
+            """
+            await conn.execute(drop_query)
+
+
+async def migrate_giveaway_identity(db: asyncpg.pool.Pool):
     """
-    res = await db.fetch(query)
-    if not res:
-        return 0
-    res = res[0]['id']
-    return res + 1
+    Turns the legacy manually assigned `giveaways.id` into an identity column continuing from the current highest ID
+    Also allows `message_id` to be empty, as giveaways are reserved before their message is sent
 
+    :param db: The database object
+    :return: None
+    """
+    query = """
+    SELECT 1 FROM information_schema.columns WHERE table_name='giveaways' AND column_name='id' AND is_identity='NO'
+    """
+    if not await db.fetch(query):
+        return
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            identity_query = """
+            ALTER TABLE giveaways ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY
+            """
+            await conn.execute(identity_query)
+            restart_query = """
+            SELECT setval(pg_get_serial_sequence('giveaways', 'id'), coalesce(max(id) + 1, 1), false) FROM giveaways
+            """
+            await conn.execute(restart_query)
+            message_id_query = """
+            ALTER TABLE giveaways ALTER COLUMN message_id DROP NOT NULL
+            """
+            await conn.execute(message_id_query)
 
-async def create_giveaway(db: asyncpg.pool.Pool, id: int, ctx: commands.Context, length: int, prize_name: str,
-                          host: str,
+
+async def load_active_state(db: asyncpg.pool.Pool):
+    """
+    Loads all unrolled giveaways and gates into the in-memory registry and the giveaway scheduler, and all templates
+    into the template cache, in a single round trip
+
+    :param db: The database object
+    :return: None
+    """
+    query = """
+    SELECT
+        (SELECT coalesce(json_agg(g), '[]') FROM (
+            SELECT id, message_id, requirements, winners, ends_at, weight_roles, weights FROM giveaways
+            WHERE winners IS NULL AND message_id IS NOT NULL
+        ) g) AS giveaways,
+        (SELECT coalesce(json_agg(g), '[]') FROM (
+            SELECT id, channel_id, ends_at, requirements FROM giveaway_gates
+        ) g) AS gates,
+        (SELECT coalesce(json_agg(t), '[]') FROM (
+            SELECT id, alias, roles FROM giveaway_gates_template
+        ) t) AS templates
+    """
+    res = await db.fetchrow(query)
+    giveaways = json.loads(res['giveaways'])
+    registry.load(giveaways, json.loads(res['gates']))
+    scheduler.load(giveaways)
+    template_cache.clear()
+    templates = json.loads(res['templates'])
+    # template IDs are looked up before aliases, so they win over an alias with the same name
+    for template in templates:
+        for alias in template['alias'] or []:
+            template_cache[alias] = template['roles']
+    for template in templates:
+        template_cache[template['id']] = template['roles']
+
+
+async def create_giveaway(db: asyncpg.pool.Pool, channel_id: int, length: int, prize_name: str, host: int,
                           winner_count: int = 1,
                           image: str = None,
-                          requirements=None, starts_at: int = None):
+                          requirements=None, starts_at: int = None, weights: dict = None):
     """
-    Create a new giveaway
+    Reserves a new giveaway, its ID is assigned by the database
+    The giveaway stays inactive until its message is attached with `attach_giveaway_message`
 
     :param db: The database object
-    :param id: The id of the giveaway, can be fetched with `get_next_id`
-    :param ctx: Context of the giveaway message, used to obatin `message_id` and `channel_id`
+    :param channel_id: The ID of the channel the giveaway message will be sent in
     :param length: How long should the giveaway last for (in seconds)
     :param prize_name: The name of the prize
-    :param host: The host of the giveaway
+    :param host: The ID of the host of the giveaway
     :param winner_count: How many winner should there be
     :param image: The image of the giveaway (Optional)
     :param requirements: A list with all the roles that is allowed to participate in the giveaway (Optional)
     :param starts_at: Customize the starting time, if not provided uses int(time.time())
-    :return: None
+    :param weights: A dict of role ID to the amount of entries members with that role get (Optional)
+    :return: The ID of the new giveaway
     """
     if requirements is None:
         requirements = []
+    if weights is None:
+        weights = {}
     query = """
     INSERT INTO giveaways 
-    (id, message_id, channel_id, created_at, length, winner_count, prize_name, image, host,requirements) VALUES 
+    (channel_id, created_at, length, winner_count, prize_name, image, host, requirements, weight_roles, weights) VALUES 
     ($1, $2 ,$3, $4, $5, $6, $7, $8, $9, $10)
+    RETURNING id
+    """
+    res = await db.fetch(query, channel_id, int(time.time()) if starts_at is None else starts_at,
+                         length, winner_count, prize_name, image, host, requirements,
+                         list(weights.keys()), list(weights.values()))
+    return res[0]['id']
+
+
+async def attach_giveaway_message(db: asyncpg.pool.Pool, id: int, message_id: int):
+    """
+    Attaches the sent giveaway message to a reserved giveaway, activating it
+
+    :param db: The database object
+    :param id: The giveaway ID returned by `create_giveaway`
+    :param message_id: The ID of the giveaway message
+    :return: None
+    """
+    query = """
+    UPDATE giveaways SET message_id=$1 WHERE id=$2
+    RETURNING id, message_id, requirements, winners, ends_at, weight_roles, weights
+    """
+    res = await db.fetch(query, message_id, id)
+    registry.add_giveaway(res[0])
+    scheduler.schedule(id, res[0]['ends_at'])
+
+
+async def delete_giveaway(db: asyncpg.pool.Pool, id: int):
+    """
+    Deletes a giveaway, used to release a reservation whose message could not be sent
+
+    :param db: The database object
+    :param id: The giveaway ID
+    :return: None
+    """
+    query = """
+    DELETE FROM giveaways WHERE id=$1
+    """
+    await db.execute(query, id)
+    registry.remove_giveaway(id)
+    scheduler.cancel(id)
+
+
+async def delete_stale_reservations(db: asyncpg.pool.Pool, older_than: int):
+    """
+    Deletes reserved giveaways whose message was never attached, eg. the process died while sending it
+
+    :param db: The database object
+    :param older_than: Only reservations created before this UNIX timestamp are deleted, so ones being sent stay
+    :return: The amount of reservations deleted
+    """
+    query = """
+    DELETE FROM giveaways WHERE message_id IS NULL AND created_at<$1
+    """
+    res = await db.execute(query, older_than)
+    return int(res.split(' ')[-1])
+
+
+def meets_requirements(requirements, member: discord.Member):
+    """
+    Checks if the member has one of the required roles
+
+    :param requirements: A list of role IDs, empty or None means no requirements
+    :param member: A :class:`discord.Member` object to check
+    :return: bool : If the member meets the requirements or not
     """
-    await db.execute(query, id, ctx.message.id, ctx.channel.id, int(time.time()) if starts_at is None else starts_at,
-                     length, winner_count, prize_name,
-                     image, host, requirements)
+    if not requirements:
+        return True
+    user_role_ids = {role.id for role in member.roles}
+    return any(req in user_role_ids for req in requirements)
+
+
+def qualifying_role(requirements, member: discord.Member):
+    """
+    Gets the required role the member qualifies with
+
+    :param requirements: A list of role IDs, empty or None means no requirements
+    :param member: A :class:`discord.Member` object to check
+    :return: The first required role ID the member has, None if there are no requirements or they have none of them
+    """
+    if not requirements:
+        return None
+    user_role_ids = {role.id for role in member.roles}
+    return next((req for req in requirements if req in user_role_ids), None)
+
+
+def entry_weight(weights: dict, member: discord.Member):
+    """
+    Gets the amount of entries the member gets, the highest weight of their roles
+    The weight is stored when the member joins and used as is when rolling, roles gained or lost afterwards only
+    count if they react again
+
+    :param weights: A dict of role ID to weight
+    :param member: A :class:`discord.Member` object to get the weight of
+    :return: The weight, 1 if none of their roles have a weight
+    """
+    return max([weights[role.id] for role in member.roles if role.id in weights], default=1)
 
 
 async def add_participant(db: asyncpg.pool.Pool, id: int, member: discord.Member):
@@ -127,23 +498,17 @@ async def add_participant(db: asyncpg.pool.Pool, id: int, member: discord.Member
     :return: bool : If the the user has qualified for the giveaway or not
     """
     query = """
-    SELECT requirements FROM giveaways WHERE id=$1
+    SELECT requirements, weight_roles, weights FROM giveaways WHERE id=$1
     """
-    reqs = (await db.fetch(query, id))[0]['requirements']
-    user_role_ids = [role.id for role in member.roles]
-    qualified = False
-    for req in reqs:
-        if req in user_role_ids:
-            qualified = True
-            break
-    if len(reqs) == 0:
-        qualified = True
-    if not qualified:
+    res = (await db.fetch(query, id))[0]
+    if not meets_requirements(res['requirements'], member):
         return False
+    weight = entry_weight(dict(zip(res['weight_roles'] or [], res['weights'] or [])), member)
     query = """
-    UPDATE giveaways SET participants = array_append(participants, $1) WHERE id=$2
+    INSERT INTO giveaway_participants (giveaway_id, user_id, weight, qualifying_role) VALUES ($1, $2, $3, $4)
+    ON CONFLICT (giveaway_id, user_id) DO UPDATE SET weight=EXCLUDED.weight, qualifying_role=EXCLUDED.qualifying_role
     """
-    await db.execute(query, member.id, id)
+    await db.execute(query, id, member.id, weight, qualifying_role(res['requirements'], member))
     return True
 
 
@@ -158,74 +523,135 @@ async def remove_participant(db: asyncpg.pool.Pool, id: int, member: discord.Mem
     :return: Nothing
     """
     query = """
-        SELECT participants FROM giveaways WHERE id=$1
-        """
-    parts = (await db.fetch(query, id))[0]['participants']
-    if member.id not in parts:
-        raise NotParticipated
-    query = """
-        UPDATE giveaways SET participants = array_remove(participants, $1)
+    DELETE FROM giveaway_participants WHERE giveaway_id=$1 AND user_id=$2
     """
-    await db.execute(query, member.id)
+    res = await db.execute(query, id, member.id)
+    if res == 'DELETE 0':
+        raise NotParticipated
+
+
+# Claims an unrolled giveaway, a giveaway being rolled by another worker is skipped instead of waited for,
+# so workers on several replicas split a burst of endings between them
+# NO KEY UPDATE does not conflict with the KEY SHARE locks taken by participant inserts, so a busy giveaway is not
+# mistaken for one being rolled
+_claim_giveaway_query = """
+SELECT winner_count, coalesce(cardinality(weight_roles), 0) > 0 AS weighted,
+       (SELECT count(*) FROM giveaway_participants WHERE giveaway_id=$1) AS n
+FROM giveaways WHERE id=$1 AND winners IS NULL FOR NO KEY UPDATE SKIP LOCKED
+"""
+# Locks a giveaway for a reroll, waiting for any roll in progress
+_lock_giveaway_query = """
+SELECT winner_count, coalesce(cardinality(weight_roles), 0) > 0 AS weighted,
+       (SELECT count(*) FROM giveaway_participants WHERE giveaway_id=$1) AS n
+FROM giveaways WHERE id=$1 FOR NO KEY UPDATE
+"""
+# Picks the participants at the given positions, drawn uniformly in Python
+_roll_flat_query = """
+WITH picked AS (SELECT array_agg(user_id) AS winners FROM (
+    SELECT user_id, row_number() OVER (ORDER BY user_id) - 1 AS position
+    FROM giveaway_participants WHERE giveaway_id=$1
+) s WHERE position = ANY($2::bigint[]))
+UPDATE giveaways SET winners=coalesce(picked.winners, ARRAY[0]::bigint[])
+FROM picked WHERE giveaways.id=$1
+RETURNING giveaways.*
+"""
+# Weighted sampling without replacement (Efraimidis-Spirakis), the $2 participants with the smallest exponential
+# keys -ln(1 - u) / weight win, done as a single top-N heap sort in O(n log k)
+# u is derived from the first 52 bits of sha256(seed || user_id), with a secret seed drawn in Python by the
+# cryptographically secure generator for every roll, 52 bits so it converts to float8 exactly and stays below 1
+_roll_weighted_query = """
+WITH picked AS (SELECT array_agg(user_id) AS winners FROM (
+    SELECT user_id FROM giveaway_participants WHERE giveaway_id=$1
+    ORDER BY -ln(1.0 - ('x' || left(encode(sha256(convert_to($3 || user_id::text, 'UTF8')), 'hex'), 13))
+                       ::bit(52)::bigint::float8 / 4503599627370496.0) / weight
+    LIMIT $2
+) s)
+UPDATE giveaways SET winners=coalesce(picked.winners, ARRAY[0]::bigint[])
+FROM picked WHERE giveaways.id=$1
+RETURNING giveaways.*
+"""
+
+
+async def roll_giveaway(db: asyncpg.pool.Pool, id: int, reroll: bool = False):
+    """
+    Rolls winner(s) of the giveaway inside the database, winner count automatically fetched
+    Winners are picked by their position among the participants, drawn with a cryptographically secure generator,
+    so only the winners are ever sent over the network
+    Giveaways with weights are sampled with weighted keys in the database instead, derived from a seed drawn with
+    the same generator, over the weights stored when the participants joined
+    If there are not enough participants, winners are set to [0]
+
+    :param db: The database object
+    :param id: The giveaway ID
+    :param reroll: Whether to roll again if the giveaway has already been rolled, defaults to False
+    :return: A dict with all informations about the giveaway after rolling, with the amount of participants as
+             `participant_count`, None if the giveaway does not exist, has already been rolled or is being rolled by
+             another worker
+    """
+    await participant_writer.flush(db, id)
+    res = None
+    async with db.acquire() as conn:
+        try:
+            async with conn.transaction(isolation='repeatable_read'):
+                giveaway = await conn.fetchrow(_lock_giveaway_query if reroll else _claim_giveaway_query, id)
+                if giveaway is not None:
+                    participant_count = giveaway['n']
+                    winner_count = giveaway['winner_count']
+                    enough = 0 < winner_count <= participant_count
+                    if giveaway['weighted']:
+                        update_query = _roll_weighted_query
+                        args = (winner_count if enough else 0, secrets.token_hex(32))
+                    else:
+                        update_query = _roll_flat_query
+                        args = (_secure_random.sample(range(participant_count), winner_count) if enough else [],)
+                    res = dict(await conn.fetchrow(update_query, id, *args))
+                    res['participant_count'] = participant_count
+        except asyncpg.SerializationError:
+            # rolled concurrently by another worker
+            res = None
+    registry.remove_giveaway(id)
+    scheduler.cancel(id)
+    return res
 
 
 async def roll_winner(db: asyncpg.pool.Pool, id: int):
     """
-    Rolls winner(s) from the database
+    Rolls winner(s) from the database, rolls again if it has already been rolled
     Winner count automatically fetched
     
     :param db: The database object
     :param id: The giveaway ID
+    :raises RollUnavailable
     :raises NotEnoughParticipants
     :raises NoParticipant
     :return: The winner's ID
     """
-    query = """
-    SELECT participants, winner_count FROM giveaways WHERE id=$1
-    """
-    res = await db.fetch(query, id)
-    participants = res[0]['participants']
-    winner_count = res[0]['winner_count']
-    if participants is None:
-        query = """
-            UPDATE giveaways SET winners=$1 WHERE id=$2
-            """
-        await db.execute(query, [0], id)
+    res = await roll_giveaway(db, id, reroll=True)
+    if res is None:
+        raise RollUnavailable
+    if res['participant_count'] == 0:
         raise NoParticipants
-    if len(participants) < winner_count:
-        query = """
-                    UPDATE giveaways SET winners=$1 WHERE id=$2
-                    """
-        await db.execute(query, [0], id)
+    if res['participant_count'] < res['winner_count']:
         raise NotEnoughParticipants
-    else:
-        winners = random.sample(participants, winner_count)
-    query = """
-    UPDATE giveaways SET winners=$1 WHERE id=$2
-    """
-    await db.execute(query, winners, id)
-    return winners
+    return res['winners']
+
+
+_need_rolling_query = """
+SELECT id FROM giveaways WHERE winners IS NULL AND message_id IS NOT NULL AND ends_at<$1 ORDER BY ends_at LIMIT $2
+"""
 
 
-async def get_need_rolling_giveaways(db: asyncpg.pool.Pool):
+async def get_need_rolling_giveaways(db: asyncpg.pool.Pool, limit: int = 50):
     """
-    Fetches all giveaways that has ended and does not have a winner
+    Fetches giveaways that has ended at least ROLL_GRACE seconds ago and does not have a winner, earliest ended first
     Note: this does not do any actions with it, manually rolling is necessary
 
     :param db: The database object
+    :param limit: The maximum amount of giveaways to fetch in one batch, defaults to 50
     :return: The giveaway's ID(s) in a list
     """
-    query = """
-    SELECT id, created_at, length FROM giveaways WHERE winners IS NULL
-    """
-    res = await db.fetch(query)
-    ret = []
-    for i in res:
-        if i['created_at'] + i['length'] < int(time.time()):
-            ret.append(i['id'])
-        else:
-            continue
-    return ret
+    res = await db.fetch(_need_rolling_query, int(time.time() - ROLL_GRACE), limit)
+    return [i['id'] for i in res]
 
 
 async def get_info_of_giveaway(db: asyncpg.pool.Pool, id: int):
@@ -234,28 +660,148 @@ async def get_info_of_giveaway(db: asyncpg.pool.Pool, id: int):
 
     :param db: The database object
     :param id: The giveaway ID
-    :return: A dict that contains all informations stored in the database about the giveaway
+    :return: A dict that contains all informations stored in the database about the giveaway,
+             with the amount of participants as `participant_count`
     """
     query = """
-    SELECT * FROM giveaways WHERE id=$1
+    SELECT *, (SELECT count(*) FROM giveaway_participants WHERE giveaway_id=$1) AS participant_count
+    FROM giveaways WHERE id=$1
     """
     res = await db.fetch(query, id)
     return dict(res[0])
 
 
+async def get_participants(db: asyncpg.pool.Pool, id: int):
+    """
+    Fetches the participants of the giveaway
+
+    :param db: The database object
+    :param id: The giveaway ID
+    :return: The participants' ID(s) in a list
+    """
+    query = """
+    SELECT user_id FROM giveaway_participants WHERE giveaway_id=$1
+    """
+    return [i['user_id'] for i in await db.fetch(query, id)]
+
+
+async def iter_participants(db: asyncpg.pool.Pool, id: int, page_size: int = 1000):
+    """
+    Streams the participants of the giveaway in ascending user ID order, one page at a time
+
+    :param db: The database object
+    :param id: The giveaway ID
+    :param page_size: How many participants to fetch per query, defaults to 1000
+    :return: An async iterator of user IDs
+    """
+    query = """
+    SELECT user_id FROM giveaway_participants WHERE giveaway_id=$1 AND user_id>$2 ORDER BY user_id LIMIT $3
+    """
+    after = -1
+    while True:
+        res = await db.fetch(query, id, after, page_size)
+        for i in res:
+            yield i['user_id']
+        if len(res) < page_size:
+            return
+        after = res[-1]['user_id']
+
+
+async def iter_participant_export(db: asyncpg.pool.Pool, id: int, batch_size: int = 1000):
+    """
+    Streams the participants of the giveaway with their entry time, qualifying role and whether they won, from a
+    server-side cursor, so only one batch is held in memory at a time
+
+    :param db: The database object
+    :param id: The giveaway ID
+    :param batch_size: How many participants to fetch per round trip, defaults to 1000
+    :return: An async iterator of lists of records, in entry order, participants of unknown entry time first
+    """
+    query = """
+    SELECT p.user_id, p.weight, p.joined_at, p.qualifying_role, coalesce(p.user_id = ANY(g.winners), false) AS winner
+    FROM giveaway_participants p JOIN giveaways g ON g.id = p.giveaway_id
+    WHERE p.giveaway_id=$1
+    ORDER BY p.joined_at NULLS FIRST, p.user_id
+    """
+    async with db.acquire() as conn:
+        # cursors only live inside a transaction
+        async with conn.transaction(readonly=True):
+            cursor = await conn.cursor(query, id)
+            while True:
+                batch = await cursor.fetch(batch_size)
+                if not batch:
+                    return
+                yield batch
+                if len(batch) < batch_size:
+                    return
+
+
+async def apply_participant_diff(db: asyncpg.pool.Pool, id: int, joins: dict, leaves: list):
+    """
+    Adds and removes participants of the giveaway in a single transaction
+
+    :param db: The database object
+    :param id: The giveaway ID
+    :param joins: A dict of user ID to (weight, qualifying role ID) of the participants to add
+    :param leaves: The user IDs of the participants to remove
+    :return: None
+    """
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            if leaves:
+                leave_query = """
+                DELETE FROM giveaway_participants WHERE giveaway_id=$1 AND user_id = ANY($2::bigint[])
+                """
+                await conn.execute(leave_query, id, leaves)
+            if joins:
+                join_query = """
+                INSERT INTO giveaway_participants (giveaway_id, user_id, weight, qualifying_role)
+                SELECT $1, * FROM unnest($2::bigint[], $3::int[], $4::bigint[])
+                ON CONFLICT (giveaway_id, user_id) DO UPDATE
+                SET weight=EXCLUDED.weight, qualifying_role=EXCLUDED.qualifying_role
+                """
+                await conn.execute(join_query, id, list(joins.keys()), [v[0] for v in joins.values()],
+                                   [v[1] for v in joins.values()])
+
+
+async def get_active_giveaways(db: asyncpg.pool.Pool):
+    """
+    Fetches the giveaways that have a message and have not been rolled
+
+    :param db: The database object
+    :return: A list of records with id, message_id, channel_id, requirements, weight_roles and weights
+    """
+    query = """
+    SELECT id, message_id, channel_id, requirements, weight_roles, weights FROM giveaways
+    WHERE winners IS NULL AND message_id IS NOT NULL
+    """
+    return await db.fetch(query)
+
+
+# One fixed statement per indexed column, so asyncpg can reuse the prepared statement and its plan
+_search_giveaway_queries = {
+    'id': """
+    SELECT * FROM giveaways WHERE id=$1
+    """,
+    'message_id': """
+    SELECT * FROM giveaways WHERE message_id=$1
+    """,
+}
+
+
 async def search_giveaway(db: asyncpg.pool.Pool, target: str, value):
     """
     Search a giveaway based on the provided information
 
     :param db: The database object
-    :param target: The column name (eg. message_id)
+    :param target: The column name, must be an indexed one (id or message_id)
     :param value: The value of the target to search with
+    :raises ValueError: If target is not a searchable column
     :return: The first result as a dict or None if not found
     """
-    query = f"""
-    SELECT * FROM giveaways WHERE {target}=$1
-    """
-    res = await db.fetch(query, value)
+    if target not in _search_giveaway_queries:
+        raise ValueError(f'Cannot search giveaways by {target}')
+    res = await db.fetch(_search_giveaway_queries[target], value)
     if len(res) == 0:
         return None
     return dict(res[0])
@@ -277,7 +823,14 @@ async def add_gate(db: asyncpg.pool.Pool, channel_id: int, message_id: int, last
     (id, channel_id, ends_at, requirements) VALUES 
     ($1, $2 ,$3, $4)
     """
-    await db.execute(query, message_id, channel_id, last_for + int(time.time()) + 5, requirements)
+    ends_at = last_for + int(time.time()) + 5
+    await db.execute(query, message_id, channel_id, ends_at, requirements)
+    registry.add_gate({'id': message_id, 'channel_id': channel_id, 'ends_at': ends_at, 'requirements': requirements})
+
+
+_search_gate_query = """
+SELECT * FROM giveaway_gates WHERE id=$1 AND channel_id=$2
+"""
 
 
 async def search_gate(db: asyncpg.pool.Pool, channel_id: int, message_id: int):
@@ -289,10 +842,7 @@ async def search_gate(db: asyncpg.pool.Pool, channel_id: int, message_id: int):
     :param message_id: The message ID to look for gates
     :return: The gate's information, None if not found
     """
-    query = f"""
-        SELECT * FROM giveaway_gates WHERE id=$1 AND channel_id=$2
-        """
-    res = await db.fetch(query, message_id, channel_id)
+    res = await db.fetch(_search_gate_query, message_id, channel_id)
     if len(res) == 0:
         return None
     return dict(res[0])
@@ -323,18 +873,24 @@ async def remove_gate(db: asyncpg.pool.Pool, channel_id: int, message_id: int):
     DELETE FROM giveaway_gates WHERE channel_id=$1 AND id=$2 
     """
     await db.execute(query, channel_id, message_id)
+    registry.remove_gate(channel_id, message_id)
 
 
-async def clear_expired_gates(db: asyncpg.pool.Pool):
+async def clear_expired_gates(db: asyncpg.pool.Pool, now: int = None, ids: list = None):
     """
     Removes all gate that has expired
     :param db: The database object
+    :param now: Customize the current time, if not provided uses int(time.time())
+    :param ids: Only remove the expired gates on these message IDs (Optional)
     :return: None
     """
     query = """
-    DELETE FROM giveaway_gates WHERE ends_at<=$1
+    DELETE FROM giveaway_gates WHERE ends_at<=$1 AND ($2::bigint[] IS NULL OR id = ANY($2::bigint[]))
     """
-    await db.execute(query, int(time.time()))
+    if now is None:
+        now = int(time.time())
+    await db.execute(query, now, ids)
+    registry.remove_expired_gates(now, ids)
 
 
 async def get_ending_soon_gates(db: asyncpg.pool.Pool, remaining: int = 30):
@@ -371,6 +927,7 @@ async def modify_gate(db: asyncpg.pool.Pool, channel_id: int, message_id: int, n
         channel_id=$2 AND id=$3   
     """
     await db.execute(query, new_requirements, channel_id, message_id)
+    registry.modify_gate(channel_id, message_id, new_requirements)
 
 
 async def get_gate_template(db: asyncpg.pool.Pool, template_id: str):
@@ -380,21 +937,41 @@ async def get_gate_template(db: asyncpg.pool.Pool, template_id: str):
     :param template_id: The template id to query of, can be the alias of it
     :return: The template result, None if not found
     """
+    if template_id in template_cache:
+        return list(template_cache[template_id])
     query = """
     SELECT roles FROM giveaway_gates_template WHERE id=$1
     """
     res = await db.fetch(query, template_id)
     if len(res) == 0:
         aliased_query = """
-        SELECT roles FROM giveaway_gates_template WHERE $1=ANY(alias)
+        SELECT roles FROM giveaway_gates_template WHERE alias @> ARRAY[$1::text]
         """
         res = await db.fetch(aliased_query, template_id)
         if len(res) == 0:
             return None
+    template_cache[template_id] = list(res[0]['roles'])
+    return res[0]['roles']
+
+
+async def parse_requirements(db: asyncpg.pool.Pool, requirements: str):
+    """
+    Parses space separated requirements, each either a role ID or a template ID / alias, into role IDs
+    Unknown templates are ignored
+
+    :param db: The database object
+    :param requirements: The requirements to parse
+    :return: A list of role IDs
+    """
+    new_reqs = []
+    for req in requirements.split(' '):
+        if not req.isdigit():
+            res = await get_gate_template(db, req)
+            if res is not None:
+                new_reqs.extend(res)
         else:
-            return res[0]['roles']
-    else:
-        return res[0]['roles']
+            new_reqs.append(int(req))
+    return new_reqs
 
 
 async def add_gate_template(db: asyncpg.pool.Pool, template_id: str, roles: list):
@@ -411,6 +988,7 @@ async def add_gate_template(db: asyncpg.pool.Pool, template_id: str, roles: list
     if not all([isinstance(x, int) for x in roles]):
         raise TypeError(f'Not of the values in roles are integer')
     await db.execute(query, template_id, roles)
+    template_cache.clear()
 
 
 async def remove_gate_template(db: asyncpg.pool.Pool, template_id: str):
@@ -424,6 +1002,7 @@ async def remove_gate_template(db: asyncpg.pool.Pool, template_id: str):
     DELETE FROM giveaway_gates_template WHERE id=$1
     """
     await db.execute(query, template_id)
+    template_cache.clear()
 
 
 async def add_template_alias(db: asyncpg.pool.Pool, template_id: str, aliases: list):
@@ -440,6 +1019,7 @@ async def add_template_alias(db: asyncpg.pool.Pool, template_id: str, aliases: l
     if not all([isinstance(x, str) for x in aliases]):
         raise TypeError(f'Not of the values in roles are string')
     await db.execute(query, aliases, template_id)
+    template_cache.clear()
     ret_query = """
     SELECT alias FROM giveaway_gates_template WHERE id=$1
     """
@@ -459,6 +1039,7 @@ async def remove_template_alias(db: asyncpg.pool.Pool, template_id: str, alias:
     UPDATE giveaway_gates_template SET alias=ARRAY_REMOVE(alias, $1) WHERE id=$2
     """
     await db.execute(query, alias, template_id)
+    template_cache.clear()
 
 
 async def add_template_role(db: asyncpg.pool.Pool, template_id: str, role_id: int):
@@ -473,6 +1054,7 @@ async def add_template_role(db: asyncpg.pool.Pool, template_id: str, role_id: in
     UPDATE giveaway_gates_template SET roles=ARRAY_APPEND(roles, $1) WHERE id=$2
     """
     await db.execute(query, role_id, template_id)
+    template_cache.clear()
 
 
 async def remove_template_role(db: asyncpg.pool.Pool, template_id: str, role_id: int):
@@ -487,6 +1069,7 @@ async def remove_template_role(db: asyncpg.pool.Pool, template_id: str, role_id:
     UPDATE giveaway_gates_template SET roles=ARRAY_REMOVE(roles, $2) WHERE id=$1
     """
     await db.execute(query, template_id, role_id)
+    template_cache.clear()
 
 
 async def purge_template_invalid_roles(db: asyncpg.pool.Pool, guild: discord.Guild, template_id: str):
@@ -511,6 +1094,7 @@ async def purge_template_invalid_roles(db: asyncpg.pool.Pool, guild: discord.Gui
     UPDATE giveaway_gates_template SET roles=$1 WHERE id=$2
     """
     await db.execute(update_query, res, template_id)
+    template_cache.clear()
     return res
 
 
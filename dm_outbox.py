@@ -0,0 +1,107 @@
+import asyncio
+import itertools
+import logging
+import time
+
+import discord
+
+
+class DirectMessageOutbox:
+    """
+    Background queue of direct messages
+    Notices to the same user within `window` seconds are coalesced into one message, notices with the same key
+    replace each other so only the latest is sent
+    Users with closed DMs (403) are remembered for `closed_ttl` seconds and not retried meanwhile
+    """
+
+    def __init__(self, window: float = 3, rate: float = 5, closed_ttl: float = 86400):
+        """
+        :param window: How long to wait for more notices to a user before sending, in seconds, defaults to 3
+        :param rate: The maximum amount of direct messages sent per second, defaults to 5
+        :param closed_ttl: How long to remember users with closed DMs, in seconds, defaults to a day
+        """
+        self.window = window
+        self.interval = 1 / rate
+        self.closed_ttl = closed_ttl
+        self.pending = {}
+        self.closed = {}
+        self.sent = 0
+        self.coalesced = 0
+        self._last_sent = 0
+        self._keys = itertools.count()
+        self._queued = asyncio.Event()
+
+    def send(self, user, content: str = None, embed: discord.Embed = None, key=None):
+        """
+        Queues a direct message
+
+        :param user: The :class:`discord.User` or :class:`discord.Member` to send to
+        :param content: The content of the notice (Optional)
+        :param embed: The embed of the notice (Optional)
+        :param key: Notices with the same key to the same user replace each other, eg. ('participation', message_id)
+        :return: bool : If the notice has been queued or not, it is not if the user has closed DMs
+        """
+        closed_at = self.closed.get(user.id)
+        if closed_at is not None:
+            if time.monotonic() - closed_at < self.closed_ttl:
+                return False
+            del self.closed[user.id]
+        if user.id not in self.pending:
+            self.pending[user.id] = {'user': user, 'due': time.monotonic() + self.window, 'notices': {}}
+            self._queued.set()
+        else:
+            self.coalesced += 1
+        notices = self.pending[user.id]['notices']
+        if key is None:
+            key = next(self._keys)
+        notices.pop(key, None)
+        notices[key] = (content, embed)
+        return True
+
+    def _forget_closed(self):
+        # users are remembered in the order their DMs were found closed, so the expired ones are first
+        now = time.monotonic()
+        while self.closed:
+            user_id, closed_at = next(iter(self.closed.items()))
+            if now - closed_at < self.closed_ttl:
+                return
+            del self.closed[user_id]
+
+    async def drain(self):
+        """
+        Waits for the earliest queued user to be due, then sends their notices
+        Meant to be called in a loop
+
+        :return: None
+        """
+        self._forget_closed()
+        if not self.pending:
+            self._queued.clear()
+            await self._queued.wait()
+            return
+        # users are queued in order, so the first one is always the earliest due
+        user_id, entry = next(iter(self.pending.items()))
+        delay = entry['due'] - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+            return
+        del self.pending[user_id]
+        contents = [content for content, _ in entry['notices'].values() if content is not None]
+        embeds = [embed for _, embed in entry['notices'].values() if embed is not None]
+        messages = [('\n'.join(contents) or None, embeds[0] if embeds else None)]
+        messages.extend([(None, embed) for embed in embeds[1:]])
+        for content, embed in messages:
+            delay = self._last_sent + self.interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._last_sent = time.monotonic()
+            try:
+                await entry['user'].send(content=content, embed=embed)
+                self.sent += 1
+            except discord.Forbidden:
+                self.closed.pop(user_id, None)
+                self.closed[user_id] = time.monotonic()
+                return
+            except discord.HTTPException as error:
+                logging.warning(f'Failed to send direct message to {str(user_id)}: {error}')
+                return
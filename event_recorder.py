@@ -0,0 +1,130 @@
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+
+
+class EventRecorder:
+    """
+    Appends raw reaction and member events to a JSON lines file, each with its time offset since the recording
+    started, so a burst can be replayed offline with `python -m benchmarks.replay`
+    The giveaway or gate on a message is written the first time a reaction on it is recorded, and again if it has
+    been forgotten since, only the `max_targets` most recently reacted messages are remembered
+    Lines are buffered and written by a background thread, once `flush_lines` lines are buffered or at most
+    `flush_interval` seconds after the first of them, so the event loop never waits on the file
+    Events must be recorded from within the event loop
+    """
+
+    def __init__(self, path: str, registry, max_targets: int = 10000, flush_lines: int = 256,
+                 flush_interval: float = 1):
+        """
+        :param path: The file to append to
+        :param registry: The :class:`ActiveMessageRegistry` to look the reacted messages up in
+        :param max_targets: How many reacted messages to remember, defaults to 10000
+        :param flush_lines: How many lines to buffer before writing them, defaults to 256
+        :param flush_interval: How long to buffer lines for at most, in seconds, defaults to 1
+        """
+        self.registry = registry
+        self.max_targets = max_targets
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self._file = open(path, 'a')
+        # a single thread keeps the writes in order
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='event_recorder')
+        self._start = time.monotonic()
+        self._targets = collections.OrderedDict()
+        self._buffer = []
+        self._timer = None
+
+    def _write(self, event_type: str, **fields):
+        fields['t'] = round(time.monotonic() - self._start, 6)
+        fields['type'] = event_type
+        self._buffer.append(json.dumps(fields) + '\n')
+        if len(self._buffer) >= self.flush_lines:
+            self.flush()
+        elif self._timer is None:
+            # the end of a burst is written even if no event follows it
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self.flush)
+
+    def _write_chunk(self, chunk: str):
+        self._file.write(chunk)
+        self._file.flush()
+
+    def flush(self):
+        """
+        Hands the buffered lines to the writer thread
+
+        :return: None
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        chunk = ''.join(self._buffer)
+        self._buffer = []
+        self._writer.submit(self._write_chunk, chunk)
+
+    @staticmethod
+    def _roles(member):
+        if member is None:
+            return []
+        return [role.id for role in member.roles if role.id != member.guild.id]
+
+    def reaction(self, payload, member):
+        """
+        Records a raw reaction add or remove
+
+        :param payload: The :class:`discord.RawReactionActionEvent`
+        :param member: The reacting :class:`discord.Member`, None if not cached
+        :return: None
+        """
+        if payload.message_id in self._targets:
+            self._targets.move_to_end(payload.message_id)
+        else:
+            self._targets[payload.message_id] = None
+            if len(self._targets) > self.max_targets:
+                self._targets.popitem(last=False)
+            giveaway = self.registry.get_giveaway(payload.message_id)
+            gate = self.registry.get_gate(payload.channel_id, payload.message_id)
+            if giveaway is not None:
+                self._write('giveaway', channel_id=payload.channel_id, message_id=payload.message_id,
+                            requirements=giveaway['requirements'], weights=list(giveaway['weights'].items()))
+            if gate is not None:
+                self._write('gate', channel_id=payload.channel_id, message_id=payload.message_id,
+                            requirements=gate['requirements'], remaining=max(gate['ends_at'] - int(time.time()), 0))
+        # event_type is REACTION_ADD or REACTION_REMOVE
+        self._write(payload.event_type.lower(), guild_id=payload.guild_id,
+                    channel_id=payload.channel_id, message_id=payload.message_id, user_id=payload.user_id,
+                    emoji=str(payload.emoji), roles=self._roles(member))
+
+    def member_join(self, member):
+        self._write('member_join', guild_id=member.guild.id, user_id=member.id, roles=self._roles(member))
+
+    def member_remove(self, member):
+        self._write('member_remove', guild_id=member.guild.id, user_id=member.id, roles=self._roles(member))
+
+    def member_update(self, before, after):
+        """
+        Records a member update, only if their roles have changed
+
+        :param before: The :class:`discord.Member` object before the update
+        :param after: The :class:`discord.Member` object after the update
+        :return: None
+        """
+        before_roles = self._roles(before)
+        after_roles = self._roles(after)
+        if set(before_roles) != set(after_roles):
+            self._write('member_update', guild_id=after.guild.id, user_id=after.id, roles_before=before_roles,
+                        roles=after_roles)
+
+    def close(self):
+        """
+        Writes the buffered lines and closes the file, waiting for the writer thread
+
+        :return: None
+        """
+        self.flush()
+        self._writer.shutdown(wait=True)
+        self._file.close()
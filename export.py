@@ -0,0 +1,122 @@
+"""
+Exports the participants of a giveaway, with their entry time, qualifying role and whether they won, as a gzipped CSV
+or JSON lines file, streaming them from the database one batch at a time:
+    python export.py 1234 --format csv --output giveaway-1234.csv.gz
+
+The bot's `export` command uses the same writer
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+
+import asyncpg
+
+import db
+
+FORMATS = ('csv', 'jsonl')
+FIELDS = ('user_id', 'weight', 'joined_at', 'qualifying_role', 'winner')
+
+
+def _row(record):
+    joined_at = record['joined_at']
+    return {
+        'user_id': str(record['user_id']),
+        'weight': record['weight'],
+        # participants from before entry times were recorded have none
+        'joined_at': datetime.datetime.fromtimestamp(joined_at, datetime.timezone.utc).isoformat()
+        if joined_at is not None else None,
+        'qualifying_role': str(record['qualifying_role']) if record['qualifying_role'] is not None else None,
+        'winner': record['winner'],
+    }
+
+
+def _encode(batch, fmt: str, header: bool):
+    out = io.StringIO(newline='')
+    if fmt == 'csv':
+        writer = csv.DictWriter(out, fieldnames=FIELDS)
+        if header:
+            writer.writeheader()
+        writer.writerows([_row(record) for record in batch])
+    else:
+        out.writelines([json.dumps(_row(record)) + '\n' for record in batch])
+    return out.getvalue().encode('utf-8')
+
+
+def _write_batch(gz: gzip.GzipFile, batch, fmt: str, header: bool):
+    gz.write(_encode(batch, fmt, header))
+
+
+async def write_export(pool: asyncpg.pool.Pool, giveaway_id: int, fileobj, fmt: str = 'csv',
+                       batch_size: int = 1000):
+    """
+    Writes the participants of the giveaway to a binary file object, gzipped
+    Each batch is encoded and compressed in a worker thread, so a large export does not hold up the event loop
+
+    :param pool: The database object
+    :param giveaway_id: The giveaway ID
+    :param fileobj: A binary file object opened for writing, left open
+    :param fmt: Either 'csv' or 'jsonl', defaults to 'csv'
+    :param batch_size: How many participants to fetch and write at a time, defaults to 1000
+    :return: The amount of participants written
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown export format {fmt}, expected one of {", ".join(FORMATS)}')
+    loop = asyncio.get_running_loop()
+    count = 0
+    # the file object is left open when the gzip stream is closed
+    gz = gzip.GzipFile(fileobj=fileobj, mode='wb')
+    try:
+        async for batch in db.iter_participant_export(pool, giveaway_id, batch_size):
+            await loop.run_in_executor(None, _write_batch, gz, batch, fmt, count == 0)
+            count += len(batch)
+        if count == 0:
+            await loop.run_in_executor(None, _write_batch, gz, [], fmt, True)
+    finally:
+        await loop.run_in_executor(None, gz.close)
+    return count
+
+
+async def run(args):
+    if args.dsn is not None:
+        connect_kwargs = {'dsn': args.dsn}
+    else:
+        with open('token.json', 'r') as f:
+            connect_kwargs = json.loads(f.read())['pgsql']
+    pool = await asyncpg.create_pool(**connect_kwargs, min_size=1, max_size=1)
+    try:
+        if await db.search_giveaway(pool, 'id', args.giveaway_id) is None:
+            raise SystemExit(f'Giveaway ID {args.giveaway_id} does not exist')
+        output = args.output or f'giveaway-{args.giveaway_id}.{args.format}.gz'
+        # written under a temporary name, so a failed export does not leave a truncated file at the output path
+        partial = f'{output}.partial'
+        try:
+            with open(partial, 'wb') as f:
+                count = await write_export(pool, args.giveaway_id, f, args.format, args.batch_size)
+            os.replace(partial, output)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+    finally:
+        await pool.close()
+    print(f'Exported {count} participants to {output}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('giveaway_id', type=int)
+    parser.add_argument('--dsn', default=None, help='Defaults to the pgsql section of token.json')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--output', help='Defaults to giveaway-<giveaway_id>.<format>.gz')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Starts the bot in cluster mode, one process per shard range, configured by the "cluster" section of token.json:
+    "cluster": {"shard_count": 8, "processes": 2}
+
+    python launcher.py
+
+Processes that exit are restarted, the launcher stops them all when interrupted
+"""
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# environment variable telling a bot process which shard range it owns
+PROCESS_ENV = 'SBZ_CLUSTER_PROCESS'
+
+
+def shard_ranges(shard_count: int, processes: int):
+    """
+    Splits the shards into contiguous ranges, one per process, as even as possible
+
+    :param shard_count: The total amount of shards
+    :param processes: The amount of processes
+    :return: A list of shard ID lists, one per process
+    """
+    if not 0 < processes <= shard_count:
+        raise ValueError(f'Cannot split {shard_count} shards between {processes} processes')
+    per_process, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for i in range(processes):
+        end = start + per_process + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+def spawn(process: int):
+    return subprocess.Popen([sys.executable, 'bot.py'], env={**os.environ, PROCESS_ENV: str(process)})
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    with open('token.json', 'r') as f:
+        cluster = json.loads(f.read())['cluster']
+    ranges = shard_ranges(cluster['shard_count'], cluster['processes'])
+    children = {}
+    for process, shards in enumerate(ranges):
+        logging.warning(f'Starting process {process} with shards {shards[0]}-{shards[-1]}')
+        children[process] = spawn(process)
+
+    def stop(signum, frame):
+        for child in children.values():
+            child.terminate()
+        for child in children.values():
+            child.wait()
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    while True:
+        time.sleep(5)
+        for process, child in children.items():
+            if child.poll() is not None:
+                logging.warning(f'Process {process} exited with code {child.returncode}, restarting')
+                children[process] = spawn(process)
+
+
+if __name__ == '__main__':
+    main()
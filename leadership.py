@@ -0,0 +1,98 @@
+import asyncio
+import logging
+
+import asyncpg
+
+# advisory lock key shared by every replica, arbitrary but must not collide with other users of the database
+LOCK_KEY = 95827438
+# base key of the per shard range leadership, offset by the cluster process number
+SHARD_LOCK_KEY = 95827500
+
+
+class Leadership:
+    """
+    Elects one leader among the replicas of the bot by holding a session level Postgres advisory lock on a dedicated
+    connection
+    Postgres releases the lock when the leader's connection drops, the other replicas try to take it every `interval`
+    seconds, so one of them takes over shortly after
+    The leader checks its connection every `interval` seconds as well and steps down as soon as it is lost
+    """
+
+    def __init__(self, connect_kwargs: dict, key: int = LOCK_KEY, interval: float = 5):
+        """
+        :param connect_kwargs: Keyword arguments for :func:`asyncpg.connect`
+        :param key: The advisory lock key, defaults to LOCK_KEY
+        :param interval: How often to try to take the lock, or to check the connection, in seconds, defaults to 5
+        """
+        self.connect_kwargs = connect_kwargs
+        self.key = key
+        self.interval = interval
+        self.conn = None
+        self._elected = asyncio.Event()
+        self._task = None
+
+    @property
+    def is_leader(self):
+        return self._elected.is_set()
+
+    async def wait_elected(self):
+        """
+        Waits until this replica is the leader, returns immediately if it already is
+
+        :return: None
+        """
+        await self._elected.wait()
+
+    async def start(self):
+        """
+        Starts campaigning in the background
+
+        :return: None
+        """
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """
+        Stops campaigning and releases the lock by closing the connection
+
+        :return: None
+        """
+        if self._task is not None:
+            self._task.cancel()
+        self._step_down()
+        if self.conn is not None and not self.conn.is_closed():
+            await self.conn.close()
+
+    def _step_down(self):
+        if self.is_leader:
+            logging.warning('Lost scheduler leadership')
+        self._elected.clear()
+
+    def _terminated(self, conn):
+        self._step_down()
+
+    async def _run(self):
+        while True:
+            try:
+                await self._campaign()
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as error:
+                logging.warning(f'Leadership connection failed: {error}')
+                self._step_down()
+                if self.conn is not None:
+                    self.conn.terminate()
+                self.conn = None
+            await asyncio.sleep(self.interval)
+
+    async def _campaign(self):
+        if self.conn is None or self.conn.is_closed():
+            self._step_down()
+            self.conn = await asyncpg.connect(**self.connect_kwargs)
+            self.conn.add_termination_listener(self._terminated)
+        if self.is_leader:
+            # a half-open connection may still hold the lock on the server side, but this replica can no longer
+            # tell, rolls are claimed row by row so a short overlap cannot roll a giveaway twice
+            await self.conn.fetchval('SELECT 1', timeout=self.interval)
+            return
+        if await self.conn.fetchval('SELECT pg_try_advisory_lock($1)', self.key, timeout=self.interval):
+            logging.warning('Became scheduler leader')
+            self._elected.set()
@@ -0,0 +1,88 @@
+import collections
+import time
+
+
+class MessageCache:
+    """
+    TTL/LRU cache of fetched messages keyed by (channel_id, message_id)
+    Entries are dropped on raw message and reaction events that would make them stale
+    Counts the fetches avoided per call site, either by a cache hit or by using a partial message
+    """
+
+    def __init__(self, ttl: float = 300, max_size: int = 500):
+        """
+        :param ttl: How long a fetched message is reused, in seconds, defaults to 300
+        :param max_size: The maximum amount of messages kept, defaults to 500
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.avoided = collections.Counter()
+        self.fetched = collections.Counter()
+
+    async def fetch(self, channel, message_id: int, site: str):
+        """
+        Gets a message, fetching it only if it is not cached or has expired
+
+        :param channel: The channel object of the message
+        :param message_id: The message ID
+        :param site: The name of the call site, used for the counters
+        :return: The :class:`discord.Message`
+        """
+        key = (channel.id, message_id)
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self.entries.move_to_end(key)
+            self.avoided[site] += 1
+            return entry[0]
+        msg = await channel.fetch_message(message_id)
+        self.fetched[site] += 1
+        self.entries[key] = (msg, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return msg
+
+    def partial(self, channel, message_id: int, site: str):
+        """
+        Gets a partial message for edit-only call sites, which needs no fetch
+
+        :param channel: The channel object of the message
+        :param message_id: The message ID
+        :param site: The name of the call site, used for the counters
+        :return: The :class:`discord.PartialMessage`
+        """
+        self.avoided[site] += 1
+        return channel.get_partial_message(message_id)
+
+    def invalidate(self, channel_id: int, message_id: int):
+        """
+        Drops a message from the cache
+
+        :param channel_id: The channel ID of the message
+        :param message_id: The message ID
+        :return: None
+        """
+        self.entries.pop((channel_id, message_id), None)
+
+    def on_reaction_add(self, channel_id: int, message_id: int, emoji: str):
+        """
+        Drops a cached message if the reaction is a new emoji on it, its reaction list would be stale
+
+        :param channel_id: The channel ID of the message
+        :param message_id: The message ID
+        :param emoji: The emoji reacted with, as a string
+        :return: None
+        """
+        entry = self.entries.get((channel_id, message_id))
+        if entry is not None and not any(str(i.emoji) == emoji for i in entry[0].reactions):
+            self.invalidate(channel_id, message_id)
+
+    def stats(self):
+        """
+        Formats the per call site counters
+
+        :return: A string like `site: avoided/total`
+        """
+        sites = sorted(set(self.avoided) | set(self.fetched))
+        return ', '.join([f'{site}: {self.avoided[site]}/{self.avoided[site] + self.fetched[site]}' for site in sites])
@@ -0,0 +1,190 @@
+import asyncio
+import bisect
+import collections
+import functools
+import inspect
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+DESCRIPTIONS = {
+    'sbz_db_query_seconds': ('histogram', 'Duration of the db module coroutines, per function'),
+    'sbz_task_iteration_seconds': ('histogram', 'Duration of a task loop iteration'),
+    'sbz_task_overruns_total': ('counter', 'Task loop iterations that took longer than the loop interval'),
+    'sbz_db_pool_acquire_seconds': ('histogram', 'Time waited to acquire a connection from the pool, sampled'),
+    'sbz_db_pool_size': ('gauge', 'Connections currently opened by the pool'),
+    'sbz_db_pool_utilization': ('gauge', 'Fraction of the pool maximum size currently in use'),
+    'sbz_event_loop_lag_seconds': ('gauge', 'How late the last sampling sleep woke up'),
+    'sbz_reaction_events_total': ('counter', 'Raw reaction events received'),
+    'sbz_cold_start_seconds': ('gauge', 'Time from bot.py being imported to the first ready'),
+}
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Collects timings and counters and exposes them in the Prometheus text format over HTTP
+    Disabled until `enable` is called, every recording method then returns immediately and nothing is wrapped
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.histograms = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self._runner = None
+
+    def enable(self):
+        self.enabled = True
+
+    def observe(self, name: str, value: float, **labels):
+        if self.enabled:
+            self.histograms[(name, tuple(labels.items()))].observe(value)
+
+    def inc(self, name: str, amount: int = 1, **labels):
+        if self.enabled:
+            self.counters[(name, tuple(labels.items()))] += amount
+
+    def set(self, name: str, value: float, **labels):
+        if self.enabled:
+            self.gauges[(name, tuple(labels.items()))] = value
+
+    def instrument_module(self, module):
+        """
+        Wraps every coroutine function defined in the module so its duration is recorded as sbz_db_query_seconds
+        Callers must look the functions up on the module (eg. `db.roll_giveaway`) to go through the wrappers
+        Does nothing if metrics are disabled
+
+        :param module: The module to instrument, usually `db`
+        :return: None
+        """
+        if not self.enabled:
+            return
+        for name, func in list(vars(module).items()):
+            if (inspect.iscoroutinefunction(func) and func.__module__ == module.__name__
+                    and not hasattr(func, '__wrapped__')):
+                setattr(module, name, self._timed(func, name))
+
+    def _timed(self, func, name: str):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.observe('sbz_db_query_seconds', time.perf_counter() - start, query=name)
+
+        return wrapper
+
+    def timed_loop(self, name: str, interval: float):
+        """
+        Decorator for the coroutine of a task loop, recording the duration of each iteration and if it took longer
+        than the loop interval
+
+        :param name: The task name, used as label
+        :param interval: The loop interval, in seconds
+        :return: The decorator
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return await func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    duration = time.perf_counter() - start
+                    self.observe('sbz_task_iteration_seconds', duration, task=name)
+                    if duration > interval:
+                        self.inc('sbz_task_overruns_total', task=name)
+
+            return wrapper
+
+        return decorator
+
+    async def sample(self, pool, interval: float = 5):
+        """
+        Sleeps for `interval` seconds and records how late it woke up as the event loop lag, then samples the pool
+        Meant to be called in a loop
+
+        :param pool: The :class:`asyncpg.pool.Pool` to sample, skipped if None
+        :param interval: The sampling interval, in seconds, defaults to 5
+        :return: None
+        """
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        self.set('sbz_event_loop_lag_seconds', max(time.perf_counter() - start - interval, 0))
+        if pool is None:
+            return
+        size = pool.get_size()
+        self.set('sbz_db_pool_size', size)
+        self.set('sbz_db_pool_utilization', (size - pool.get_idle_size()) / pool.get_max_size())
+        start = time.perf_counter()
+        async with pool.acquire():
+            self.observe('sbz_db_pool_acquire_seconds', time.perf_counter() - start)
+
+    def render(self):
+        """
+        Formats everything collected in the Prometheus text exposition format
+
+        :return: The formatted text
+        """
+        samples = collections.defaultdict(list)
+        for (name, labels), value in self.counters.items():
+            samples[name].append((name, labels, value))
+        for (name, labels), value in self.gauges.items():
+            samples[name].append((name, labels, value))
+        for (name, labels), histogram in self.histograms.items():
+            cumulative = 0
+            for le, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                cumulative += count
+                samples[name].append((f'{name}_bucket', labels + (('le', le),), cumulative))
+            samples[name].append((f'{name}_sum', labels, histogram.sum))
+            samples[name].append((f'{name}_count', labels, histogram.count))
+        lines = []
+        for name in sorted(samples):
+            kind, description = DESCRIPTIONS.get(name, ('untyped', ''))
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sample_name, labels, value in samples[name]:
+                formatted = ','.join([f'{k}="{v}"' for k, v in labels])
+                lines.append(f'{sample_name}{{{formatted}}} {value}' if formatted else f'{sample_name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    async def start(self, host: str = '127.0.0.1', port: int = 9100):
+        """
+        Serves the metrics on http://host:port/metrics
+
+        :param host: The address to bind, defaults to localhost only
+        :param port: The port to bind, defaults to 9100
+        :return: None
+        """
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request):
+        from aiohttp import web
+        return web.Response(text=self.render(), content_type='text/plain')
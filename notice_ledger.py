@@ -0,0 +1,105 @@
+import collections
+import itertools
+import logging
+import time
+
+import asyncpg
+
+
+class NoticeLedger:
+    """
+    Bounded TTL set of (gate_id, user_id) pairs that have been sent a gate denial notice
+    Least recently noticed pairs are evicted once `max_size` is reached
+    Can be persisted in the `giveaway_notices` table, so notices are not sent again after a restart
+    """
+
+    def __init__(self, ttl: int = 43200, max_size: int = 100000):
+        """
+        :param ttl: How long a pair is remembered, in seconds, defaults to 12 hours
+        :param max_size: The maximum amount of pairs kept in memory, defaults to 100000
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self._unsaved = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def should_notify(self, gate_id: int, user_id: int):
+        """
+        Checks if the user should be sent a denial notice for the gate, and records it if so
+
+        :param gate_id: The gate ID
+        :param user_id: The user ID
+        :return: bool : If the notice should be sent or not
+        """
+        key = (gate_id, user_id)
+        now = int(time.time())
+        expires_at = self.entries.get(key)
+        if expires_at is not None and expires_at > now:
+            return False
+        self._add(key, now + self.ttl)
+        self._unsaved.pop(key, None)
+        self._unsaved[key] = now + self.ttl
+        self._trim_unsaved()
+        return True
+
+    def _trim_unsaved(self):
+        # bounded like the entries while the database is unreachable, the oldest pairs are the least useful
+        overflow = len(self._unsaved) - self.max_size
+        if overflow <= 0:
+            return
+        for key in list(itertools.islice(self._unsaved, overflow)):
+            del self._unsaved[key]
+        logging.warning(f'Notice ledger has dropped {overflow} unsaved pairs, they will not survive a restart')
+
+    def _add(self, key, expires_at: int):
+        self.entries.pop(key, None)
+        self.entries[key] = expires_at
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def load(self, db: asyncpg.pool.Pool):
+        """
+        Loads the unexpired pairs from the database, the most recent ones are kept if there are too many
+
+        :param db: The database object
+        :return: None
+        """
+        query = """
+        SELECT gate_id, user_id, expires_at FROM giveaway_notices WHERE expires_at>$1 ORDER BY expires_at DESC LIMIT $2
+        """
+        res = await db.fetch(query, int(time.time()), self.max_size)
+        for i in reversed(res):
+            self._add((i['gate_id'], i['user_id']), i['expires_at'])
+
+    async def save(self, db: asyncpg.pool.Pool):
+        """
+        Writes the pairs recorded since the last save to the database, and deletes the expired ones
+
+        :param db: The database object
+        :return: None
+        """
+        unsaved = self._unsaved
+        self._unsaved = {}
+        try:
+            async with db.acquire() as conn:
+                async with conn.transaction():
+                    if unsaved:
+                        query = """
+                        INSERT INTO giveaway_notices (gate_id, user_id, expires_at)
+                        SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[])
+                        ON CONFLICT (gate_id, user_id) DO UPDATE SET expires_at=EXCLUDED.expires_at
+                        """
+                        await conn.execute(query, [k[0] for k in unsaved], [k[1] for k in unsaved],
+                                           list(unsaved.values()))
+                    prune_query = """
+                    DELETE FROM giveaway_notices WHERE expires_at<=$1
+                    """
+                    await conn.execute(prune_query, int(time.time()))
+        except Exception:
+            # pairs recorded meanwhile are newer, they stay last and win
+            self._unsaved = {**unsaved, **self._unsaved}
+            self._trim_unsaved()
+            raise
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+
+import asyncpg
+
+# how often the buffer is flushed when not full, in seconds
+FLUSH_INTERVAL = 0.25
+
+
+class ParticipantWriter:
+    """
+    Write-behind buffer of participant joins and leaves
+    Events are collected per (giveaway, user) and written to `giveaway_participants` in bulk,
+    only the last event of a (giveaway, user) pair within a batch is kept, so a join followed by a leave cancels out
+    """
+
+    def __init__(self, max_pending: int = 1000):
+        self.pending = {}
+        self.max_pending = max_pending
+        self._lock = asyncio.Lock()
+        self._full = asyncio.Event()
+
+    def join(self, giveaway_id: int, user_id: int, weight: int = 1, role: int = None):
+        """
+        Queues a participant join
+
+        :param giveaway_id: The giveaway ID
+        :param user_id: The ID of the user joining
+        :param weight: The amount of entries the user gets, defaults to 1
+        :param role: The ID of the required role the user qualified with, None if there are no requirements
+        :return: None
+        """
+        self._queue(giveaway_id, user_id, (weight, role))
+
+    def leave(self, giveaway_id: int, user_id: int):
+        """
+        Queues a participant leave
+
+        :param giveaway_id: The giveaway ID
+        :param user_id: The ID of the user leaving
+        :return: None
+        """
+        self._queue(giveaway_id, user_id, None)
+
+    def _queue(self, giveaway_id: int, user_id: int, entry):
+        key = (giveaway_id, user_id)
+        # re-insert so the dict keeps the order of the last event of every pair, an entry of None is a leave
+        self.pending.pop(key, None)
+        self.pending[key] = entry
+        if len(self.pending) >= self.max_pending:
+            self._full.set()
+
+    async def wait(self, interval: float):
+        """
+        Waits until the flush interval has passed or the buffer has reached `max_pending`
+
+        :param interval: The flush interval in seconds
+        :return: None
+        """
+        try:
+            await asyncio.wait_for(self._full.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+    async def flush(self, db: asyncpg.pool.Pool, giveaway_id: int = None):
+        """
+        Writes the buffered events in a single transaction
+
+        :param db: The database object
+        :param giveaway_id: Only flush the events of this giveaway, flushes everything if not provided
+        :return: None
+        """
+        async with self._lock:
+            if giveaway_id is None:
+                batch = self.pending
+                self.pending = {}
+                self._full.clear()
+            else:
+                batch = {k: v for k, v in self.pending.items() if k[0] == giveaway_id}
+                for key in batch:
+                    del self.pending[key]
+            if not batch:
+                return
+            joins = [(k, v) for k, v in batch.items() if v is not None]
+            leaves = [k for k, v in batch.items() if v is None]
+            try:
+                async with db.acquire() as conn:
+                    async with conn.transaction():
+                        if leaves:
+                            leave_query = """
+                            DELETE FROM giveaway_participants p
+                            USING unnest($1::int[], $2::bigint[]) AS d(giveaway_id, user_id)
+                            WHERE p.giveaway_id=d.giveaway_id AND p.user_id=d.user_id
+                            """
+                            await conn.execute(leave_query, [k[0] for k in leaves], [k[1] for k in leaves])
+                        if joins:
+                            # joined_at keeps the time of the first entry
+                            join_query = """
+                            INSERT INTO giveaway_participants (giveaway_id, user_id, weight, qualifying_role)
+                            SELECT * FROM unnest($1::int[], $2::bigint[], $3::int[], $4::bigint[])
+                            ON CONFLICT (giveaway_id, user_id) DO UPDATE
+                            SET weight=EXCLUDED.weight, qualifying_role=EXCLUDED.qualifying_role
+                            WHERE (giveaway_participants.weight, giveaway_participants.qualifying_role)
+                                  IS DISTINCT FROM (EXCLUDED.weight, EXCLUDED.qualifying_role)
+                            """
+                            await conn.execute(join_query, [k[0] for k, _ in joins], [k[1] for k, _ in joins],
+                                               [v[0] for _, v in joins], [v[1] for _, v in joins])
+            except Exception:
+                # put back whatever has not been superseded by newer events meanwhile
+                for key, weight in batch.items():
+                    self.pending.setdefault(key, weight)
+                logging.error(f'Failed to flush {len(batch)} participant events, requeued')
+                raise
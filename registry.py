@@ -0,0 +1,198 @@
+class ActiveMessageRegistry:
+    """
+    In-memory write-through registry of messages that have an active giveaway or gate on them
+    Lets the reaction handlers tell if a message is one of ours without touching the database
+    """
+
+    def __init__(self):
+        self.giveaways = {}
+        self.gates = {}
+        self._giveaway_messages = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, giveaways, gates):
+        """
+        Replaces the registry content with the provided records
+
+        :param giveaways: Records of unrolled giveaways, each with at least id, message_id, requirements, winners,
+                          weight_roles and weights
+        :param gates: Records of gates, each with at least id, channel_id, ends_at and requirements
+        :return: None
+        """
+        self.giveaways = {}
+        self.gates = {}
+        self._giveaway_messages = {}
+        for giveaway in giveaways:
+            self.add_giveaway(giveaway)
+        for gate in gates:
+            self.add_gate(gate)
+
+    def is_tracked(self, message_id: int):
+        """
+        Checks if the message has an active giveaway or gate, counting hits and misses
+
+        :param message_id: The message ID to check
+        :return: bool : If the message is tracked or not
+        """
+        if message_id in self.giveaways or message_id in self.gates:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def get_giveaway(self, message_id: int):
+        """
+        Gets the active giveaway on message_id
+
+        :param message_id: The message ID of the giveaway
+        :return: The giveaway record as a dict, None if not found
+        """
+        return self.giveaways.get(message_id)
+
+    def get_gate(self, channel_id: int, message_id: int):
+        """
+        Gets the gate on message_id
+
+        :param channel_id: The channel ID of the gated message
+        :param message_id: The message ID of the gated message
+        :return: The gate record as a dict, None if not found
+        """
+        gate = self.gates.get(message_id)
+        if gate is None or gate['channel_id'] != channel_id:
+            return None
+        return gate
+
+    def add_giveaway(self, giveaway):
+        """
+        Registers an unrolled giveaway
+
+        :param giveaway: The giveaway record, with at least id, message_id, requirements, winners, weight_roles and
+                         weights
+        :return: None
+        """
+        record = {'id': giveaway['id'], 'message_id': giveaway['message_id'],
+                  'requirements': list(giveaway['requirements'] or []), 'winners': giveaway['winners'],
+                  'weights': dict(zip(giveaway['weight_roles'] or [], giveaway['weights'] or []))}
+        self.giveaways[record['message_id']] = record
+        self._giveaway_messages[record['id']] = record['message_id']
+
+    def remove_giveaway(self, giveaway_id: int):
+        """
+        Unregisters a giveaway, used once it has been rolled
+
+        :param giveaway_id: The giveaway ID
+        :return: None
+        """
+        message_id = self._giveaway_messages.pop(giveaway_id, None)
+        if message_id is not None:
+            self.giveaways.pop(message_id, None)
+
+    def add_gate(self, gate):
+        """
+        Registers a gate, replacing the existing one on the same message
+
+        :param gate: The gate record, with at least id, channel_id, ends_at and requirements
+        :return: None
+        """
+        requirements = list(gate['requirements'] or [])
+        existing = self.gates.get(gate['id'])
+        # reactors verified against the same requirements stay verified
+        verified = existing['verified'] if existing is not None and existing['requirements'] == requirements else {}
+        self.gates[gate['id']] = {'id': gate['id'], 'channel_id': gate['channel_id'], 'ends_at': gate['ends_at'],
+                                  'requirements': requirements, 'verified': verified}
+
+    def modify_gate(self, channel_id: int, message_id: int, requirements):
+        """
+        Updates the requirements of a registered gate
+
+        :param channel_id: The channel ID of the gated message
+        :param message_id: The message ID of the gated message
+        :param requirements: The new requirements
+        :return: None
+        """
+        gate = self.get_gate(channel_id, message_id)
+        if gate is not None:
+            gate['requirements'] = list(requirements)
+            gate['verified'] = {}
+
+    def remove_gate(self, channel_id: int, message_id: int):
+        """
+        Unregisters a gate
+
+        :param channel_id: The channel ID of the gated message
+        :param message_id: The message ID of the gated message
+        :return: None
+        """
+        if self.get_gate(channel_id, message_id) is not None:
+            del self.gates[message_id]
+
+    def verify_reaction(self, channel_id: int, message_id: int, user_id: int, emoji: str):
+        """
+        Records that a reactor of a gate has been checked and qualifies
+
+        :param channel_id: The channel ID of the gated message
+        :param message_id: The message ID of the gated message
+        :param user_id: The ID of the reactor
+        :param emoji: The emoji reacted with, as a string
+        :return: None
+        """
+        gate = self.get_gate(channel_id, message_id)
+        if gate is not None:
+            gate['verified'].setdefault(user_id, set()).add(emoji)
+
+    def unverify_reaction(self, channel_id: int, message_id: int, user_id: int, emoji: str):
+        """
+        Forgets a verified reaction, used once it has been removed
+
+        :param channel_id: The channel ID of the gated message
+        :param message_id: The message ID of the gated message
+        :param user_id: The ID of the reactor
+        :param emoji: The emoji reacted with, as a string
+        :return: None
+        """
+        gate = self.get_gate(channel_id, message_id)
+        if gate is None or user_id not in gate['verified']:
+            return
+        gate['verified'][user_id].discard(emoji)
+        if not gate['verified'][user_id]:
+            del gate['verified'][user_id]
+
+    def verified_gates(self, user_id: int):
+        """
+        Gets the gates the user has verified reactions on
+
+        :param user_id: The ID of the user
+        :return: A list of gate records
+        """
+        return [gate for gate in self.gates.values() if user_id in gate['verified']]
+
+    def expired_gates(self, now: int):
+        """
+        Gets the gates that has expired
+
+        :param now: The current time
+        :return: A list of gate records
+        """
+        return [gate for gate in self.gates.values() if gate['ends_at'] <= now]
+
+    def remove_expired_gates(self, now: int, ids=None):
+        """
+        Unregisters all gates that has expired
+
+        :param now: The current time
+        :param ids: Only unregister the expired gates on these message IDs (Optional)
+        :return: None
+        """
+        if ids is not None:
+            ids = set(ids)
+        for message_id in [k for k, v in self.gates.items() if v['ends_at'] <= now and (ids is None or k in ids)]:
+            del self.gates[message_id]
+
+    def stats(self):
+        """
+        Returns the registry size and lookup counters
+
+        :return: A dict with giveaways, gates, hits and misses
+        """
+        return {'giveaways': len(self.giveaways), 'gates': len(self.gates), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import time
+
+import discord
+
+
+# how long after a removal is done its gateway event is still attributed to the queue, in seconds
+REMOVED_TTL = 60
+# how many times a removal is tried while it keeps being rate limited before it is given up
+MAX_ATTEMPTS = 5
+
+
+def _rate_limit(error):
+    """
+    Reads how long to wait from a rate limit error
+
+    :param error: A :class:`discord.RateLimited`, or a :class:`discord.HTTPException` with status 429
+    :return: The amount of seconds to wait, and whether the limit is global
+    """
+    if isinstance(error, discord.RateLimited):
+        return error.retry_after, False
+    headers = getattr(error.response, 'headers', None) or {}
+    retry_after = float(headers.get('Retry-After', 1))
+    is_global = headers.get('X-RateLimit-Global', '').lower() == 'true' or headers.get('X-RateLimit-Scope') == 'global'
+    return retry_after, is_global
+
+
+class RemovalBatch:
+    """
+    Progress of a group of queued reaction removals, eg. the ones issued by one command
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+    def _add(self):
+        self.total += 1
+        self._finished.clear()
+
+    def _complete(self, ok: bool):
+        if ok:
+            self.done += 1
+        else:
+            self.failed += 1
+        if self.done + self.failed >= self.total:
+            self._finished.set()
+
+    async def wait(self):
+        """
+        Waits until every removal of the batch has been processed
+
+        :return: None
+        """
+        await self._finished.wait()
+
+
+class ReactionRemovalQueue:
+    """
+    Central queue of reaction removals
+    Removals are deduplicated on (message, emoji, user) and processed by one worker per channel, as the reaction
+    routes are rate limited per channel, so a purge on one message does not hold up the others
+    The amount of requests in flight is bounded, leaving room under the global rate limit for other API calls
+    A rate limited removal waits for as long as the response asks before it is tried again, holding up only its
+    channel, or every channel if the limit is global
+    """
+
+    def __init__(self, get_channel, concurrency: int = 4):
+        """
+        :param get_channel: Called with a channel ID, returns the channel object, usually `bot.get_channel`
+        :param concurrency: The maximum amount of requests in flight at once, defaults to 4
+        """
+        self.get_channel = get_channel
+        self._slots = asyncio.Semaphore(concurrency)
+        self._queues = {}
+        self._queued = set()
+        # (channel ID, message ID, emoji, user ID) of the done removals to when their gateway event is no longer
+        # expected, in completion order
+        self._removed = {}
+        self._global_until = 0
+        self.rate_limited = 0
+
+    def __len__(self):
+        return len(self._queued)
+
+    def remove(self, channel_id: int, message_id: int, emoji, user_id: int, batch: RemovalBatch = None):
+        """
+        Queues the removal of a user's reaction, ignored if the same removal is already queued
+
+        :param channel_id: The channel ID of the message
+        :param message_id: The message ID
+        :param emoji: The emoji of the reaction
+        :param user_id: The ID of the user to remove the reaction of
+        :param batch: The batch to report progress to, a new one is created if not provided
+        :return: The batch
+        """
+        return self._queue(('remove', channel_id, message_id, str(emoji), user_id), batch)
+
+    def initiated(self, channel_id: int, message_id: int, emoji, user_id: int):
+        """
+        Checks whether the removal of a reaction was issued by the queue, to tell it apart from the user unreacting
+
+        :param channel_id: The channel ID of the message
+        :param message_id: The message ID
+        :param emoji: The emoji of the reaction
+        :param user_id: The ID of the user whose reaction was removed
+        :return: bool : If the removal is queued, in flight, or has been done recently
+        """
+        key = (channel_id, message_id, str(emoji), user_id)
+        if ('remove', *key) in self._queued:
+            return True
+        return self._removed.pop(key, 0) > time.monotonic()
+
+    def _forget_removed(self):
+        now = time.monotonic()
+        while self._removed:
+            key, expiry = next(iter(self._removed.items()))
+            if expiry > now:
+                return
+            del self._removed[key]
+
+    def clear(self, channel_id: int, message_id: int, emoji, readd: bool = False, batch: RemovalBatch = None):
+        """
+        Queues the removal of all reactions of an emoji on the message
+
+        :param channel_id: The channel ID of the message
+        :param message_id: The message ID
+        :param emoji: The emoji to clear
+        :param readd: Whether to react with the emoji again afterwards, used to keep the bot's own reaction
+        :param batch: The batch to report progress to, a new one is created if not provided
+        :return: The batch
+        """
+        return self._queue(('clear', channel_id, message_id, str(emoji), readd), batch)
+
+    def _queue(self, job, batch):
+        if batch is None:
+            batch = RemovalBatch()
+        if job in self._queued:
+            return batch
+        self._queued.add(job)
+        batch._add()
+        channel_id = job[1]
+        if channel_id not in self._queues:
+            self._queues[channel_id] = asyncio.Queue()
+            asyncio.ensure_future(self._work(channel_id))
+        self._queues[channel_id].put_nowait((job, batch))
+        return batch
+
+    async def _work(self, channel_id: int):
+        queue = self._queues[channel_id]
+        while not queue.empty():
+            job, batch = queue.get_nowait()
+            ok = await self._attempt(job)
+            self._queued.discard(job)
+            if ok and job[0] == 'remove':
+                self._removed.pop(job[1:], None)
+                self._removed[job[1:]] = time.monotonic() + REMOVED_TTL
+            self._forget_removed()
+            batch._complete(ok)
+        # nothing can be queued between the emptiness check and this, as there is no await in between
+        del self._queues[channel_id]
+
+    async def _attempt(self, job):
+        for _ in range(MAX_ATTEMPTS):
+            delay = self._global_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                async with self._slots:
+                    await self._run(job)
+                return True
+            except (discord.RateLimited, discord.HTTPException) as error:
+                if isinstance(error, discord.HTTPException) and error.status != 429:
+                    logging.warning(f'Reaction removal {job} has failed: {error}')
+                    return False
+                retry_after, is_global = _rate_limit(error)
+            except Exception:
+                logging.exception(f'Reaction removal {job} has failed')
+                return False
+            self.rate_limited += 1
+            logging.warning(f'Reaction removal {job} is rate limited, retrying in {retry_after:.2f}s')
+            if is_global:
+                self._global_until = max(self._global_until, time.monotonic() + retry_after)
+            # waited outside of the slots, so other channels keep going
+            await asyncio.sleep(retry_after)
+        logging.warning(f'Reaction removal {job} has failed, still rate limited after {MAX_ATTEMPTS} attempts')
+        return False
+
+    async def _run(self, job):
+        kind, channel_id, message_id, emoji, extra = job
+        msg = self.get_channel(channel_id).get_partial_message(message_id)
+        if kind == 'remove':
+            await msg.remove_reaction(emoji, discord.Object(extra))
+            logging.info(f'Removed {str(extra)} from {str(message_id)}')
+        else:
+            await msg.clear_reaction(emoji)
+            logging.info(f'Cleared {emoji} from {str(message_id)}')
+            if extra:
+                await msg.add_reaction(emoji)
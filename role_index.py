@@ -0,0 +1,116 @@
+class RoleIndex:
+    """
+    Per-guild index of role ID to the IDs of the members having it
+    Requirement lists are compiled into the union of their roles' member sets, so checking if a member qualifies
+    is a single set lookup
+    Guilds are only indexed once loaded from a complete member cache, until then `is_indexed` is False and their
+    members must be checked against their own roles
+    """
+
+    def __init__(self):
+        self.guilds = {}
+        self.indexed = set()
+        self._compiled = {}
+
+    def is_indexed(self, guild_id: int):
+        """
+        Checks if a guild has been loaded, the index of a guild still being chunked is incomplete
+
+        :param guild_id: The guild ID
+        :return: bool : If the guild has been loaded or not
+        """
+        return guild_id in self.indexed
+
+    def load_guild(self, guild):
+        """
+        (Re)builds the index of a guild from its member cache
+
+        :param guild: A :class:`discord.Guild` object
+        :return: None
+        """
+        roles = {role.id: set() for role in guild.roles}
+        for member in guild.members:
+            for role in member.roles:
+                roles.setdefault(role.id, set()).add(member.id)
+        self.guilds[guild.id] = roles
+        self.indexed.add(guild.id)
+        self._invalidate(guild.id)
+
+    def add_member(self, member):
+        """
+        Indexes all roles of a member, used when they join
+
+        :param member: A :class:`discord.Member` object
+        :return: None
+        """
+        self._update(member.guild.id, member.id, {role.id for role in member.roles}, set())
+
+    def remove_member(self, member):
+        """
+        Removes a member from the index, used when they leave
+
+        :param member: A :class:`discord.Member` object
+        :return: None
+        """
+        self._update(member.guild.id, member.id, set(), {role.id for role in member.roles})
+
+    def update_member(self, before, after):
+        """
+        Applies the role changes of a member
+
+        :param before: The :class:`discord.Member` object before the update
+        :param after: The :class:`discord.Member` object after the update
+        :return: None
+        """
+        before_roles = {role.id for role in before.roles}
+        after_roles = {role.id for role in after.roles}
+        if before_roles != after_roles:
+            self._update(after.guild.id, after.id, after_roles - before_roles, before_roles - after_roles)
+
+    def remove_role(self, guild_id: int, role_id: int):
+        """
+        Removes a deleted role from the index
+
+        :param guild_id: The guild ID of the role
+        :param role_id: The role ID
+        :return: None
+        """
+        self.guilds.get(guild_id, {}).pop(role_id, None)
+        self._invalidate(guild_id, {role_id})
+
+    def _update(self, guild_id: int, member_id: int, added: set, removed: set):
+        roles = self.guilds.setdefault(guild_id, {})
+        for role_id in added:
+            roles.setdefault(role_id, set()).add(member_id)
+        for role_id in removed:
+            roles.get(role_id, set()).discard(member_id)
+        self._invalidate(guild_id, added | removed)
+
+    def _invalidate(self, guild_id: int, role_ids: set = None):
+        for key in [k for k in self._compiled if k[0] == guild_id and (role_ids is None or role_ids & set(k[1]))]:
+            del self._compiled[key]
+
+    def qualified(self, guild_id: int, requirements):
+        """
+        Gets the members having at least one of the required roles
+
+        :param guild_id: The guild ID
+        :param requirements: A list of role IDs
+        :return: A set of member IDs, shared with the index and must not be modified
+        """
+        key = (guild_id, frozenset(requirements))
+        if key not in self._compiled:
+            roles = self.guilds.get(guild_id, {})
+            self._compiled[key] = set().union(*[roles.get(role_id, set()) for role_id in requirements])
+        return self._compiled[key]
+
+    def is_qualified(self, guild_id: int, member_id: int, requirements):
+        """
+        Checks if a member has at least one of the required roles
+
+        :param guild_id: The guild ID
+        :param member_id: The member ID
+        :param requirements: A list of role IDs
+        :return: bool : If the member qualifies or not
+        """
+        return member_id in self.qualified(guild_id, requirements)
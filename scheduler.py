@@ -0,0 +1,100 @@
+import asyncio
+import heapq
+import time
+
+
+# stale heap entries tolerated before the heap is rebuilt, as long as they do not outnumber the scheduled giveaways
+COMPACT_MIN_STALE = 64
+
+
+class GiveawayScheduler:
+    """
+    In-process min-heap of giveaway end times
+    `wait_due` sleeps until the earliest deadline, and is woken up early when an earlier one is scheduled
+    """
+
+    def __init__(self, grace: float = 0):
+        """
+        :param grace: How long after their end giveaways are due, in seconds, defaults to 0
+        """
+        self.grace = grace
+        self._heap = []
+        self._deadlines = {}
+        self._wakeup = asyncio.Event()
+
+    def load(self, giveaways):
+        """
+        Replaces the scheduled giveaways with the provided records
+
+        :param giveaways: Records of unrolled giveaways, each with at least id and ends_at
+        :return: None
+        """
+        self._heap = []
+        self._deadlines = {}
+        for giveaway in giveaways:
+            self.schedule(giveaway['id'], giveaway['ends_at'])
+        self._wakeup.set()
+
+    def schedule(self, giveaway_id: int, ends_at: int):
+        """
+        Schedules a giveaway to be rolled at ends_at, replacing its previous deadline if any
+
+        :param giveaway_id: The giveaway ID
+        :param ends_at: When the giveaway ends, as a unix timestamp
+        :return: None
+        """
+        self._deadlines[giveaway_id] = ends_at
+        heapq.heappush(self._heap, (ends_at, giveaway_id))
+        if self._heap[0] == (ends_at, giveaway_id):
+            self._wakeup.set()
+        self._compact()
+
+    def cancel(self, giveaway_id: int):
+        """
+        Unschedules a giveaway, its heap entry is discarded lazily
+
+        :param giveaway_id: The giveaway ID
+        :return: None
+        """
+        self._deadlines.pop(giveaway_id, None)
+        self._compact()
+
+    def _compact(self):
+        # replicas that are not the leader never wait, so stale entries are also dropped once they outnumber the
+        # scheduled giveaways, rebuilding the heap from the deadlines
+        stale = len(self._heap) - len(self._deadlines)
+        if stale < COMPACT_MIN_STALE or stale < len(self._deadlines):
+            return
+        self._heap = [(ends_at, giveaway_id) for giveaway_id, ends_at in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def _prune(self):
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    async def wait_due(self):
+        """
+        Waits until the earliest scheduled giveaway has ended, or until the schedule has changed
+
+        :return: The IDs of giveaways that have ended, can be empty if woken up by a schedule change
+        """
+        self._prune()
+        delay = self._heap[0][0] + self.grace - time.time() if self._heap else None
+        if delay is None or delay > 0:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        now = time.time() - self.grace
+        due = []
+        self._prune()
+        while self._heap and self._heap[0][0] <= now:
+            ends_at, giveaway_id = heapq.heappop(self._heap)
+            if self._deadlines.get(giveaway_id) == ends_at:
+                del self._deadlines[giveaway_id]
+                due.append(giveaway_id)
+        return due